@@ -0,0 +1,139 @@
+"""ASGI entry point, serving on the same event loop as the finder's searches.
+
+    SERVER_MODE=asgi uvicorn asgi:app --app-dir app --port 8080
+
+Routes and their responses match the Flask app in main.py.
+"""
+import asyncio
+import json
+import logging
+import os
+from urllib.parse import parse_qsl
+
+from werkzeug.datastructures import MultiDict
+
+os.environ.setdefault('SERVER_MODE', 'asgi')
+
+import metrics
+from listing import dumps, encode_item
+from main import (check_image, finder, image_response, query_results, search_complete_event, start_batch,
+                  start_search, start_watch, zmq_server)
+from scraper_base import close_sessions
+
+if os.environ['SERVER_MODE'] != 'asgi':
+    raise RuntimeError("asgi.py needs SERVER_MODE=asgi, main.py has already started the finder on its own loop")
+
+with open(os.path.join(os.path.dirname(os.path.abspath(__file__)), 'templates', 'index.html'), 'rb') as f:
+    INDEX_PAGE = f.read()
+
+
+async def respond(send, status, body, headers=None, content_type=b'application/json'):
+    if not isinstance(body, bytes):
+        body = dumps(body)
+    response_headers = [(b'content-type', content_type), (b'content-length', str(len(body)).encode())]
+    response_headers.extend((name.lower().encode(), value.encode()) for name, value in (headers or {}).items())
+    await send({'type': 'http.response.start', 'status': status, 'headers': response_headers})
+    await send({'type': 'http.response.body', 'body': body})
+
+
+async def read_json(receive):
+    body = b''
+    while True:
+        message = await receive()
+        body += message.get('body', b'')
+        if not message.get('more_body'):
+            break
+    try:
+        return json.loads(body)
+    except ValueError:
+        return None
+
+
+async def stream(search_id, receive, send):
+    await send({'type': 'http.response.start', 'status': 200, 'headers': [
+        (b'content-type', b'text/event-stream'),
+        (b'cache-control', b'no-cache'),
+        (b'x-accel-buffering', b'no'),
+    ]})
+
+    async def disconnected():
+        while (await receive())['type'] != 'http.disconnect':
+            pass
+
+    watcher = asyncio.ensure_future(disconnected())
+    try:
+        offset = 0
+        while not watcher.done():
+            is_searching, items, offset = await finder.store.wait_async(search_id, offset, timeout=15)
+            chunk = b''.join(b'data: ' + encode_item(item) + b'\n\n' for item in items)
+            if not is_searching:
+                chunk += search_complete_event(search_id, offset)
+                await send({'type': 'http.response.body', 'body': chunk})
+                return
+            await send({'type': 'http.response.body', 'body': chunk or b': keep-alive\n\n', 'more_body': True})
+        await send({'type': 'http.response.body', 'body': b''})
+    finally:
+        watcher.cancel()
+
+
+async def lifespan(receive, send):
+    while True:
+        message = await receive()
+        if message['type'] == 'lifespan.startup':
+            finder.start_native()
+            if zmq_server:
+                asyncio.ensure_future(zmq_server.serve())
+            await send({'type': 'lifespan.startup.complete'})
+        elif message['type'] == 'lifespan.shutdown':
+            await close_sessions()
+            finder.stop()
+            await send({'type': 'lifespan.shutdown.complete'})
+            return
+
+
+async def app(scope, receive, send):
+    if scope['type'] == 'lifespan':
+        return await lifespan(receive, send)
+    if scope['type'] != 'http':
+        return
+
+    path = scope['path']
+    args = MultiDict(parse_qsl(scope['query_string'].decode('latin-1')))
+    _, route, *rest = path.split('/', 2)
+    argument = rest[0] if rest else None
+    try:
+        if path == '/':
+            await respond(send, 200, INDEX_PAGE, content_type=b'text/html; charset=utf-8')
+        elif path == '/batch' and scope['method'] == 'POST':
+            await respond(send, *start_batch(await read_json(receive)))
+        elif route == 'search' and argument:
+            await respond(send, *start_search(argument, args.get('mode')))
+        elif route == 'results' and argument:
+            await respond(send, *query_results(argument, args))
+        elif route == 'watch' and argument:
+            await respond(send, *start_watch(argument, args.get('interval')))
+        elif route == 'unwatch' and argument:
+            finder.unwatch(argument)
+            await respond(send, 200, {"message": "Watch stopped", "watch_id": argument})
+        elif route == 'stream' and argument:
+            await stream(argument, receive, send)
+        elif route == 'img' and argument:
+            src = args.get('src')
+            error = check_image(argument, src)
+            if error:
+                await respond(send, *error)
+            else:
+                if_none_match = dict(scope['headers']).get(b'if-none-match', b'').decode('latin-1')
+                status, body, headers, content_type = image_response(
+                    await finder.images.get(argument, src), if_none_match)
+                await respond(send, status, body, headers, content_type=content_type.encode())
+        elif path == '/stats':
+            await respond(send, 200, finder.stats())
+        elif path == '/metrics':
+            await respond(send, 200, metrics.render(finder.gauges()).encode(),
+                          content_type=b'text/plain; version=0.0.4')
+        else:
+            await respond(send, 404, {"message": "Not found"})
+    except Exception as e:
+        logging.error(f"Error handling {path}: {str(e)}")
+        await respond(send, 500, {"message": "Internal server error"})
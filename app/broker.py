@@ -0,0 +1,449 @@
+"""Shared search job queues and result stores, for running searches in worker processes.
+
+A front-end enqueues jobs and reads results; workers (worker.py) run the
+jobs. Any front-end replica can then answer any search_id.
+
+    BROKER_URL=sqlite:///var/lib/finder/broker.db   processes on one host
+    BROKER_URL=zmq://broker-host:5560               processes on any host, with broker.py running there
+"""
+import asyncio
+import json
+import logging
+import sqlite3
+import threading
+import time
+import uuid
+import zlib
+from collections import deque
+from queue import Full
+from urllib.parse import urlsplit
+
+import zmq
+
+from listing import encode_item, encode_items
+from result_store import MemoryResultStore, ResultIndex, SQLiteResultStore
+
+
+class JobQueue:
+    """The queue.Queue methods UsedItemsFinder uses; get() returns None once closed."""
+    maxsize = 0
+
+    def qsize(self):
+        return 0
+
+    def task_done(self):
+        pass
+
+    def close(self):
+        self.closed = True
+
+    @staticmethod
+    def job(query, search_id, enqueued_wall):
+        # Queue wait is measured on the monotonic clock, which is per host
+        return query, search_id, time.monotonic() - max(time.time() - enqueued_wall, 0)
+
+
+class SQLiteJobQueue(JobQueue):
+    """Jobs in a SQLite table. Claiming a job deletes it, so a worker that dies mid-search loses it."""
+
+    def __init__(self, path, maxsize=100, poll_interval=0.05):
+        self.maxsize = maxsize
+        self.poll_interval = poll_interval
+        self.closed = False
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(path, check_same_thread=False, isolation_level=None, timeout=30)
+        self.db.execute('PRAGMA journal_mode=WAL')
+        self.db.execute(
+            'CREATE TABLE IF NOT EXISTS jobs ('
+            'id INTEGER PRIMARY KEY AUTOINCREMENT, search_id TEXT NOT NULL, query TEXT NOT NULL, enqueued_at REAL NOT NULL)'
+        )
+
+    def put_nowait(self, job):
+        query, search_id, _ = job
+        with self.lock:
+            self.db.execute('BEGIN IMMEDIATE')
+            try:
+                if self.maxsize and self.db.execute('SELECT COUNT(*) FROM jobs').fetchone()[0] >= self.maxsize:
+                    raise Full
+                # JSON, as a batch job's query is a list of queries
+                self.db.execute('INSERT INTO jobs (search_id, query, enqueued_at) VALUES (?, ?, ?)',
+                                (search_id, json.dumps(query), time.time()))
+                self.db.execute('COMMIT')
+            except BaseException:
+                self.db.execute('ROLLBACK')
+                raise
+
+    def get(self):
+        while not self.closed:
+            with self.lock:
+                row = self.db.execute(
+                    'DELETE FROM jobs WHERE id = (SELECT id FROM jobs ORDER BY id LIMIT 1) '
+                    'RETURNING query, search_id, enqueued_at'
+                ).fetchone()
+            if row:
+                query, search_id, enqueued_at = row
+                return self.job(json.loads(query), search_id, enqueued_at)
+            time.sleep(self.poll_interval)
+        return None
+
+    def qsize(self):
+        with self.lock:
+            return self.db.execute('SELECT COUNT(*) FROM jobs').fetchone()[0]
+
+    def close(self):
+        self.closed = True
+        with self.lock:
+            self.db.close()
+
+
+class SharedSQLiteResultStore(SQLiteResultStore):
+    """A SQLiteResultStore whose in-progress results are in the database too.
+
+    The process running a search also keeps its items in memory from the
+    first add() on, so merging them still works on Listing objects; every
+    other process reads them from the database.
+    """
+
+    def __init__(self, path, poll_interval=0.05, **kwargs):
+        super().__init__(path, **kwargs)
+        self.poll_interval = poll_interval
+        self.db.execute('PRAGMA busy_timeout=30000')
+        self.db.executescript('''
+            CREATE TABLE IF NOT EXISTS searching (search_id TEXT PRIMARY KEY, started_at REAL NOT NULL);
+            CREATE TABLE IF NOT EXISTS searching_items (
+                search_id TEXT NOT NULL, seq INTEGER NOT NULL, payload BLOB NOT NULL, PRIMARY KEY (search_id, seq)
+            );
+            CREATE TABLE IF NOT EXISTS finished_streams (search_id TEXT PRIMARY KEY, finished_at REAL NOT NULL);
+        ''')
+
+    def start(self, search_id):
+        with self.lock:
+            self.db.execute('INSERT OR IGNORE INTO searching (search_id, started_at) VALUES (?, ?)',
+                            (search_id, time.time()))
+
+    def add(self, search_id, items):
+        super().add(search_id, items)
+        with self.lock:
+            self.db.execute('BEGIN IMMEDIATE')
+            seq = self.db.execute('SELECT COALESCE(MAX(seq) + 1, 0) FROM searching_items WHERE search_id = ?',
+                                  (search_id,)).fetchone()[0]
+            self.db.executemany('INSERT INTO searching_items (search_id, seq, payload) VALUES (?, ?, ?)',
+                                [(search_id, seq + i, encode_item(item)) for i, item in enumerate(items)])
+            self.db.execute('COMMIT')
+
+    def finish(self, search_id, results=None):
+        if results is None and not self._is_local(search_id):
+            results = [json.loads(payload) for payload in self._shared_items(search_id, 0)]
+        super().finish(search_id, results)
+        now = time.time()
+        with self.lock:
+            self.db.execute('BEGIN IMMEDIATE')
+            self.db.execute('DELETE FROM searching WHERE search_id = ?', (search_id,))
+            # The items stay for stream_grace seconds, for other processes'
+            # streams still catching up (see _finished_items)
+            self.db.execute('INSERT OR REPLACE INTO finished_streams (search_id, finished_at) VALUES (?, ?)',
+                            (search_id, now))
+            self.db.execute('DELETE FROM searching_items WHERE search_id IN '
+                            '(SELECT search_id FROM finished_streams WHERE finished_at < ?)', (now - self.stream_grace,))
+            self.db.execute('DELETE FROM finished_streams WHERE finished_at < ?', (now - self.stream_grace,))
+            self.db.execute('COMMIT')
+
+    def discard(self, search_id):
+        super().discard(search_id)
+        with self.lock:
+            self.db.execute('BEGIN IMMEDIATE')
+            self.db.execute('DELETE FROM searching WHERE search_id = ?', (search_id,))
+            self.db.execute('DELETE FROM searching_items WHERE search_id = ?', (search_id,))
+            self.db.execute('COMMIT')
+
+    def trim(self, search_id, max_items):
+        super().trim(search_id, max_items)
+        with self.lock:
+            # seq counts from the first item ever added, so offsets stay as they were
+            self.db.execute('DELETE FROM searching_items WHERE search_id = ? AND seq < '
+                            '(SELECT MAX(seq) + 1 FROM searching_items WHERE search_id = ?) - ?',
+                            (search_id, search_id, max_items))
+
+    def _is_local(self, search_id):
+        with self.lock:
+            return search_id in self.pending
+
+    def _is_shared(self, search_id):
+        with self.lock:
+            return self.db.execute('SELECT 1 FROM searching WHERE search_id = ?', (search_id,)).fetchone() is not None
+
+    def _shared_items(self, search_id, offset):
+        return [payload for _, payload in self._shared_rows(search_id, offset)]
+
+    def _shared_rows(self, search_id, offset):
+        with self.lock:
+            return self.db.execute(
+                'SELECT seq, payload FROM searching_items WHERE search_id = ? AND seq >= ? ORDER BY seq',
+                (search_id, offset)
+            ).fetchall()
+
+    def is_searching(self, search_id):
+        return self._is_local(search_id) or self._is_shared(search_id)
+
+    def _finished_items(self, search_id, offset):
+        with self.lock:
+            local = search_id in self.arrivals
+        if offset and not local:
+            return [json.loads(payload) for payload in self._shared_items(search_id, offset)]
+        return super()._finished_items(search_id, offset)
+
+    def get(self, search_id):
+        if not self._is_local(search_id) and self._is_shared(search_id):
+            return True, [json.loads(payload) for payload in self._shared_items(search_id, 0)]
+        return super().get(search_id)
+
+    def get_encoded(self, search_id):
+        if not self._is_local(search_id) and self._is_shared(search_id):
+            return True, b'[' + b','.join(self._shared_items(search_id, 0)) + b']'
+        return super().get_encoded(search_id)
+
+    def _poll(self, search_id, offset):
+        """(done, result) for a search another process is running."""
+        if not self._is_shared(search_id):
+            return True, super().wait(search_id, offset, timeout=0)
+        rows = self._shared_rows(search_id, offset)
+        next_offset = rows[-1][0] + 1 if rows else offset
+        return bool(rows), (True, [json.loads(payload) for _, payload in rows], next_offset)
+
+    def wait(self, search_id, offset, timeout=None):
+        if self._is_local(search_id):
+            return super().wait(search_id, offset, timeout)
+        deadline = time.monotonic() + timeout if timeout is not None else None
+        while True:
+            done, result = self._poll(search_id, offset)
+            if done or (deadline is not None and time.monotonic() >= deadline):
+                return result
+            time.sleep(self.poll_interval)
+
+    async def wait_async(self, search_id, offset, timeout=None):
+        if self._is_local(search_id):
+            return await super().wait_async(search_id, offset, timeout)
+        deadline = time.monotonic() + timeout if timeout is not None else None
+        while True:
+            done, result = self._poll(search_id, offset)
+            if done or (deadline is not None and time.monotonic() >= deadline):
+                return result
+            await asyncio.sleep(self.poll_interval)
+
+    def query(self, search_id, **options):
+        if not self._is_local(search_id) and self._is_shared(search_id):
+            payloads = self._shared_items(search_id, 0)
+            index = ResultIndex(0, [json.loads(payload) for payload in payloads], payloads)
+            items, cursor, reset = index.select(**options)
+            return True, b'[' + b','.join(items) + b']', cursor, reset
+        return super().query(search_id, **options)
+
+    def stats(self):
+        stats = super().stats()
+        with self.lock:
+            stats["pending"] = self.db.execute('SELECT COUNT(*) FROM searching').fetchone()[0]
+        stats["backend"] = "shared-sqlite"
+        return stats
+
+
+class ZmqJobQueue(JobQueue):
+    """Jobs pushed to the ZMQ broker, which hands each to a worker that asked for one.
+
+    A worker asks (get()) only when it has a free search slot, so jobs wait
+    at the broker rather than behind a busy worker's searches. A worker that
+    dies mid-search loses its job.
+    """
+
+    def __init__(self, push_address, pull_address, maxsize=100):
+        self.push_address = push_address
+        self.pull_address = pull_address
+        self.maxsize = maxsize
+        self.closed = False
+        self.context = zmq.Context.instance()
+        self.lock = threading.Lock()
+        self.push = None
+        self.pull = None
+
+    def put_nowait(self, job):
+        query, search_id, _ = job
+        with self.lock:
+            if self.push is None:
+                self.push = self.context.socket(zmq.PUSH)
+                self.push.setsockopt(zmq.SNDHWM, self.maxsize or 1000)
+                self.push.setsockopt(zmq.LINGER, 1000)
+                self.push.connect(self.push_address)
+            try:
+                self.push.send_json([query, search_id, time.time()], zmq.NOBLOCK)
+            except zmq.Again:
+                raise Full
+
+    def get(self):
+        if self.pull is None:
+            self.pull = self.context.socket(zmq.DEALER)
+            self.pull.setsockopt(zmq.LINGER, 0)
+            self.pull.connect(self.pull_address)
+        self.pull.send(b'ready')
+        while not self.closed:
+            if self.pull.poll(100):
+                return self.job(*self.pull.recv_json())
+        return None
+
+
+class ZmqResultStore(MemoryResultStore):
+    """A MemoryResultStore kept in step across processes through the ZMQ broker.
+
+    Every store publishes its start/add/trim/finish/discard calls and applies everyone
+    else's, so each front-end holds all recent results. A process that joins
+    late misses searches started before it subscribed.
+    """
+
+    def __init__(self, publish_address, subscribe_address, **kwargs):
+        super().__init__(**kwargs)
+        self.origin = uuid.uuid4().bytes
+        self.context = zmq.Context.instance()
+        self.publish_lock = threading.Lock()
+        self.publisher = self.context.socket(zmq.PUB)
+        self.publisher.setsockopt(zmq.LINGER, 1000)
+        self.publisher.connect(publish_address)
+        self.subscribe_address = subscribe_address
+        self.closed = False
+        self.subscriber = threading.Thread(target=self._subscribe, name='result-subscriber', daemon=True)
+        self.subscriber.start()
+
+    def _publish(self, action, search_id, payload=b''):
+        with self.publish_lock:
+            self.publisher.send_multipart([action, self.origin, search_id.encode('utf-8'), payload])
+
+    def start(self, search_id):
+        super().start(search_id)
+        self._publish(b'start', search_id)
+
+    def add(self, search_id, items):
+        super().add(search_id, items)
+        self._publish(b'add', search_id, encode_items(items))
+
+    def discard(self, search_id):
+        super().discard(search_id)
+        self._publish(b'discard', search_id)
+
+    def trim(self, search_id, max_items):
+        super().trim(search_id, max_items)
+        self._publish(b'trim', search_id, str(max_items).encode())
+
+    def finish(self, search_id, results=None):
+        if results is None:
+            with self.lock:
+                results = list(self.pending.get(search_id, []))
+        super().finish(search_id, results)
+        self._publish(b'finish', search_id, zlib.compress(encode_items(results)))
+
+    def _subscribe(self):
+        socket = self.context.socket(zmq.SUB)
+        socket.setsockopt(zmq.SUBSCRIBE, b'')
+        socket.setsockopt(zmq.LINGER, 0)
+        socket.connect(self.subscribe_address)
+        try:
+            while not self.closed:
+                if not socket.poll(100):
+                    continue
+                action, origin, search_id, payload = socket.recv_multipart()
+                if origin == self.origin:
+                    continue
+                try:
+                    self._apply(action, search_id.decode('utf-8'), payload)
+                except Exception as e:
+                    logging.error(f"Error applying {action.decode()} for {search_id.decode()}: {str(e)}")
+        finally:
+            socket.close()
+
+    def _apply(self, action, search_id, payload):
+        if action == b'start':
+            super().start(search_id)
+        elif action == b'add':
+            super().add(search_id, json.loads(payload))
+        elif action == b'discard':
+            super().discard(search_id)
+        elif action == b'trim':
+            super().trim(search_id, int(payload))
+        elif action == b'finish':
+            super().finish(search_id, json.loads(zlib.decompress(payload)))
+
+    def close(self):
+        self.closed = True
+        self.subscriber.join()
+        with self.publish_lock:
+            self.publisher.close()
+
+    def stats(self):
+        return dict(super().stats(), backend="zmq")
+
+
+def zmq_addresses(host, port):
+    """Broker endpoints: jobs in, jobs out, results in, results out."""
+    return [f"tcp://{host}:{port + offset}" for offset in range(4)]
+
+
+def connect(url, max_queue_size=100, **store_options):
+    """Returns (job queue, result store) for a BROKER_URL."""
+    parts = urlsplit(url)
+    if parts.scheme == 'sqlite':
+        return SQLiteJobQueue(parts.path, max_queue_size), SharedSQLiteResultStore(parts.path, **store_options)
+    if parts.scheme == 'zmq':
+        jobs_in, jobs_out, results_in, results_out = zmq_addresses(parts.hostname or '127.0.0.1', parts.port or 5560)
+        return ZmqJobQueue(jobs_in, jobs_out, max_queue_size), ZmqResultStore(results_in, results_out, **store_options)
+    raise ValueError(f"Unknown broker: {url}")
+
+
+def balance(jobs, workers):
+    """Hand each job from jobs to the longest-waiting worker that has sent "ready".
+
+    Jobs are only read while a worker is waiting, so the backlog stays
+    within the front-ends' send high-water marks.
+    """
+    ready = deque()
+    job = None
+    poller = zmq.Poller()
+    poller.register(workers, zmq.POLLIN)
+    while True:
+        events = dict(poller.poll())
+        if events.get(workers):
+            ready.append(workers.recv_multipart()[0])
+        if events.get(jobs):
+            job = jobs.recv()
+        while job is not None and ready:
+            try:
+                workers.send_multipart([ready.popleft(), job])
+                job = None
+            except zmq.ZMQError:
+                # That worker has gone away since asking
+                pass
+        # Flags of 0 unregister jobs until a worker is waiting
+        poller.register(jobs, zmq.POLLIN if ready and job is None else 0)
+
+
+def serve(host='*', port=5560):
+    """Run the ZMQ broker: a job load balancer and a result forwarder."""
+    context = zmq.Context.instance()
+    jobs_in, jobs_out, results_in, results_out = zmq_addresses(host, port)
+
+    def device(front_type, front_address, back_type, back_address):
+        front, back = context.socket(front_type), context.socket(back_type)
+        front.bind(front_address)
+        back.bind(back_address)
+        zmq.proxy(front, back)
+
+    jobs = context.socket(zmq.PULL)
+    jobs.setsockopt(zmq.RCVHWM, 1)
+    jobs.bind(jobs_in)
+    workers = context.socket(zmq.ROUTER)
+    workers.setsockopt(zmq.ROUTER_MANDATORY, 1)
+    workers.bind(jobs_out)
+    threading.Thread(target=balance, args=(jobs, workers), daemon=True).start()
+    logging.info(f"Broker listening on {jobs_in}, {jobs_out}, {results_in}, {results_out}")
+    device(zmq.XSUB, results_in, zmq.XPUB, results_out)
+
+
+if __name__ == "__main__":
+    import os
+    logging.basicConfig(level=logging.INFO)
+    serve(os.environ.get('BROKER_HOST', '*'), int(os.environ.get('BROKER_PORT', 5560)))
@@ -0,0 +1,64 @@
+import scraper_base
+from scraper_base import ScraperBase
+from craigslist_scraper import CraigslistScraper
+import asyncio
+
+class CraigslistRegionScraper(ScraperBase):
+    offload_parse = False
+
+    def __init__(self, locations, max_per_host=4, **kwargs):
+        super().__init__()
+        # HOST_RATE, HOST_RATES and HOST_BURST as configured, with its own concurrency cap
+        self.host_limiter = scraper_base.host_limiter.derive(max_concurrency=max_per_host)
+        # Every metro shares the host limits; connections come from the shared session pool
+        self.metros = [
+            CraigslistScraper(location, host_limiter=self.host_limiter, **kwargs)
+            for location in locations
+        ]
+        for metro in self.metros:
+            metro.source = self.source
+
+    async def search(self, query, max_results=None, max_pages=None, on_page=None):
+        # Every metro is searched to the same depth, so a posting they share
+        # is still merged; the limit applies to the merged listings
+        results = await asyncio.gather(*(
+            metro.search(query, max_results=max_results, max_pages=max_pages)
+            for metro in self.metros
+        ), return_exceptions=True)
+
+        listings = []
+        failures = []
+        for metro, result in zip(self.metros, results):
+            if isinstance(result, Exception):
+                print(f"Error in Craigslist {metro.location}: {str(result)}")
+                failures.append(result)
+            else:
+                listings.append(result)
+
+        if failures and len(failures) == len(self.metros):
+            raise failures[0]
+        merged = self._merge(listings)[:max_results]
+        if on_page and merged:
+            on_page(merged)
+        return merged
+
+    async def prepare_batch(self, queries):
+        results = await asyncio.gather(*(metro.prepare_batch(queries) for metro in self.metros),
+                                       return_exceptions=True)
+        for metro, result in zip(self.metros, results):
+            if isinstance(result, Exception):
+                print(f"Error preparing Craigslist {metro.location}: {str(result)}")
+
+    @staticmethod
+    def _merge(listings):
+        merged = []
+        seen = set()
+        for listing in (listing for metro_listings in listings for listing in metro_listings):
+            # A posting shown in several metros keeps its title, price and
+            # images; without images only identical URLs are merged
+            key = (listing.name, listing.price, tuple(listing.image_urls) or listing.url)
+            if key in seen:
+                continue
+            seen.add(key)
+            merged.append(listing)
+        return merged
@@ -1,23 +1,86 @@
 from scraper_base import ScraperBase
+from search_cache import normalize_query
+from listing import Listing
+import asyncio
 import re
+import time
 
 class CraigslistScraper(ScraperBase):
-    def __init__(self, location='chicago'):
-        super().__init__()
+    offload_parse = False
+    page_size = 360
+
+    def __init__(self, location='chicago', session_ttl=1800, search_path_ttl=3600, max_search_paths=1000,
+                 session=None, host_limiter=None):
+        super().__init__(session=session, host_limiter=host_limiter)
+        self.location = location
         self.base_url = f"https://{location}.craigslist.org"
         self.api_url = "https://sapi.craigslist.org/web/v8/postings/search/full"
+        self.session_ttl = session_ttl
+        self.search_path_ttl = search_path_ttl
+        self.session_expires_at = 0.0
+        self.session_lock = None
+        self.max_search_paths = max_search_paths
+        self.search_paths = {}
 
-    async def search(self, query):
+    async def search(self, query, max_results=None, max_pages=None, on_page=None):
         await self._init_session()
-        search_path = await self._perform_search(query)
-        # testing error handling
-        data = await self._api_request(query, search_path)
-        return self._extract_listings(data) if data else []
+        return await self.search_pages(query, max_results, max_pages, on_page)
 
-    async def _init_session(self):
-        response = await self.get(self.base_url, impersonate="chrome110")
-        if response.status_code != 200:
-            raise Exception(f"Failed to initialize session: {response.status_code}")
+    async def prepare_batch(self, queries):
+        # One warm-up for the whole batch; search paths stay per query, as
+        # each query's search page can pick a different one
+        await self._init_session()
+
+    async def fetch_page(self, query, page):
+        search_path = await self._get_search_path(query)
+        offset = (page - 1) * self.page_size
+        response = await self._api_request(query, search_path, offset)
+        if response is not None and response.status_code == 403:
+            # The warm-up cookies have gone stale, get new ones and retry once
+            await self._init_session(force=True)
+            response = await self._api_request(query, search_path, offset)
+        data = self._api_data(response)
+        if not data:
+            return [], 0
+        listings = await self.parse(self._extract_listings, data)
+        total = data.get('data', {}).get('totalResultCount')
+        return listings, -(-total // self.page_size) if total else 1
+
+    async def _init_session(self, force=False):
+        if self.session_lock is None:
+            self.session_lock = asyncio.Lock()
+        expires_at = self.session_expires_at
+        async with self.session_lock:
+            # Concurrent searches share one warm-up; skip it if another
+            # search refreshed the session while we waited for the lock
+            if self.session_expires_at != expires_at or (not force and time.monotonic() < expires_at):
+                return
+            response = await self.get(self.base_url, impersonate="chrome110")
+            if response is None or response.status_code != 200:
+                self.session_expires_at = 0.0
+                status = response.status_code if response is not None else 'no response'
+                raise Exception(f"Failed to initialize session: {status}")
+            self.session_expires_at = time.monotonic() + self.session_ttl
+
+    async def _get_search_path(self, query):
+        search_path = self._cached_search_path(query)
+        if search_path is None:
+            search_path = await self._perform_search(query)
+            self._remember_search_path(query, search_path)
+        return search_path
+
+    def _cached_search_path(self, query):
+        cached = self.search_paths.get(normalize_query(query))
+        if cached and cached[0] > time.monotonic():
+            return cached[1]
+        return None
+
+    def _remember_search_path(self, query, search_path):
+        key = normalize_query(query)
+        self.search_paths.pop(key, None)
+        self.search_paths[key] = (time.monotonic() + self.search_path_ttl, search_path)
+        while len(self.search_paths) > self.max_search_paths:
+            del self.search_paths[next(iter(self.search_paths))]
 
     async def _perform_search(self, query):
         search_url = f"{self.base_url}/search/sss?query={query}"
@@ -28,9 +91,9 @@ class CraigslistScraper(ScraperBase):
         match = re.search(r'var searchPath = "([^"]+)";', response.text)
         return match.group(1) if match else "sss"
 
-    async def _api_request(self, query, search_path):
+    async def _api_request(self, query, search_path, offset=0):
         params = {
-            'batch': '11-0-360-0-0',
+            'batch': f'11-{offset}-{self.page_size}-0-0',
             'cc': 'US',
             'lang': 'en',
             'query': query,
@@ -48,13 +111,16 @@ class CraigslistScraper(ScraperBase):
             'Cache-Control': 'no-cache'
         }
 
-        response = await self.get(
+        return await self.get(
             self.api_url,
             params=params,
             headers=headers,
             impersonate="chrome110"
         )
 
+    def _api_data(self, response):
+        if response is None:
+            return None
         if response.status_code == 200:
             return response.json()
         else:
@@ -66,20 +132,18 @@ class CraigslistScraper(ScraperBase):
         items = data.get('data', {}).get('items', [])
         
         for item in items:
-            listing = {
-                'name': item[-1] if item else None,
-                'price': item[3] if len(item) > 3 else None,
-                'image_urls': [],
-                'url': None
-            }
+            listing = Listing(
+                name=item[-1] if item else None,
+                price=item[3] if len(item) > 3 else None
+            )
             
             image_data = next((sublist for sublist in item if isinstance(sublist, list) and sublist and sublist[0] == 4), None)
             if image_data:
-                listing['image_urls'] = self._construct_image_urls(image_data[1:])
+                listing.image_urls = self._construct_image_urls(image_data[1:])
             
             url_data = next((sublist for sublist in item if isinstance(sublist, list) and sublist and sublist[0] == 6), None)
             if url_data:
-                listing['url'] = self._construct_item_url(url_data)
+                listing.url = self._construct_item_url(url_data)
             
             listings.append(listing)
         return listings
@@ -1,62 +1,172 @@
-from scraper_base import ScraperBase
+from scraper_base import ScraperBase, LexborHTMLParser
+from listing import Listing
+from html_stream import ListingStream, has_class
 from bs4 import BeautifulSoup as bs
 import re
 
-class EbayScraper(ScraperBase):
+class EbayListingStream(ListingStream):
     def __init__(self):
         super().__init__()
+        self.result_count = None
+        self.in_count_heading = False
+
+    def is_container(self, tag, attrs):
+        # The result count is the text right after the heading's start tag
+        self.in_count_heading = has_class(attrs, 'srp-controls__count-heading')
+        return has_class(attrs, 'srp-results')
+
+    def outside_data(self, data):
+        if self.in_count_heading:
+            self.in_count_heading = False
+            match = re.match(r'\s*([\d,]+)', data)
+            if match:
+                self.result_count = int(match.group(1).replace(',', ''))
+
+    def is_item(self, tag, attrs):
+        return tag == 'li' and 'id' in attrs
+
+    def item_starttag(self, tag, attrs):
+        if has_class(attrs, 's-item__title'):
+            self.capture_text('name')
+        if has_class(attrs, 's-item__price'):
+            self.capture_text('price')
+        if tag == 'a' and has_class(attrs, 's-item__link'):
+            self.set_field('url', attrs.get('href'))
+        if tag == 'img':
+            self.set_field('image', attrs.get('src') or attrs.get('data-src'))
+
+    def build_listing(self, fields):
+        listing = Listing()
+        listing.name = fields.get('name', '').strip() or None
+        price_match = re.search(r'\$?([\d,]+(\.\d{2})?)', fields.get('price', '').strip())
+        if price_match:
+            listing.price = float(price_match.group(1).replace(',', ''))
+        listing.url = fields.get('url')
+        if fields.get('image'):
+            listing.image_urls = [fields['image']]
+        return listing if listing.name else None
+
+class EbayScraper(ScraperBase):
+    listing_stream = EbayListingStream
+
+    def __init__(self, parser_backend='bs4'):
+        super().__init__(parser_backend)
         self.base_url = "https://www.ebay.com/sch/i.html"
 
-    async def search(self, query):
+    async def search(self, query, max_results=None, max_pages=None, on_page=None):
+        return await self.search_pages(query, max_results, max_pages, on_page)
+
+    async def fetch_page(self, query, page, on_listings=None):
         params = {'_nkw': query}
-        response = await self.get(self.base_url, params=params)
-        
+        if page > 1:
+            params['_pgn'] = page
+        if self.parser_backend == 'stream':
+            listings, stream = await self.fetch_streamed(self.base_url, params, on_listings)
+            return listings, self._pages(stream.result_count, len(listings))
+
+        response, cached = await self.conditional_get(self.base_url, params)
+        if cached is not None:
+            return cached
+
         if response.status_code == 200:
-            return self._extract_listings(response.text)
+            listings = await self.parse(self.extractor(), response.content)
+            result = listings, self._page_count(response.content, len(listings))
+            self.remember(response, self.base_url, params, result)
+            return result
         else:
             print(f"Error: Status code {response.status_code}")
-            return []
+            return [], 0
+
+    @classmethod
+    def _page_count(cls, html, page_size):
+        # "1,000+ results for bike" is all eBay tells us about the depth
+        match = re.search(rb'srp-controls__count-heading[^>]*>\s*([\d,]+)', html)
+        return cls._pages(int(match.group(1).replace(b',', b'')) if match else None, page_size)
+
+    @staticmethod
+    def _pages(result_count, page_size):
+        if not result_count or not page_size:
+            return 1
+        return -(-result_count // page_size)
 
-    def _extract_listings(self, html):
+    @classmethod
+    def _extract_listings(cls, html):
         soup = bs(html, 'html.parser')
         listings = []
 
         ul = soup.select_one('.srp-results')
         if ul:
             for li in ul.find_all('li', id=True):
-                listing = self._parse_listing(li)
+                listing = cls._parse_listing(li)
                 if listing:
                     listings.append(listing)
 
         return listings
 
-    def _parse_listing(self, li):
-        listing = {
-            "name": None,
-            "price": None,
-            "image_urls": [],
-            "url": None
-        }
+    @classmethod
+    def _extract_listings_selectolax(cls, html):
+        tree = LexborHTMLParser(html)
+        listings = []
+
+        ul = tree.css_first('.srp-results')
+        if ul:
+            for li in ul.css('li[id]'):
+                listing = cls._parse_listing_selectolax(li)
+                if listing:
+                    listings.append(listing)
+
+        return listings
+
+    @staticmethod
+    def _parse_listing(li):
+        listing = Listing()
 
         title_elem = li.select_one('.s-item__title')
         if title_elem:
-            listing["name"] = title_elem.text.strip()
+            listing.name = title_elem.text.strip()
 
         price_elem = li.select_one('.s-item__price')
         if price_elem:
             price_text = price_elem.text.strip()
             price_match = re.search(r'\$?([\d,]+(\.\d{2})?)', price_text)
             if price_match:
-                listing["price"] = float(price_match.group(1).replace(',', ''))
+                listing.price = float(price_match.group(1).replace(',', ''))
 
         url_elem = li.select_one('a.s-item__link')
         if url_elem:
-            listing["url"] = url_elem['href']
+            listing.url = url_elem['href']
 
         img_elem = li.select_one('img')
         if img_elem:
             src = img_elem.get('src') or img_elem.get('data-src')
             if src:
-                listing["image_urls"] = [src]
+                listing.image_urls = [src]
+
+        return listing if listing.name else None
+
+    @staticmethod
+    def _parse_listing_selectolax(li):
+        listing = Listing()
+
+        title_elem = li.css_first('.s-item__title')
+        if title_elem:
+            listing.name = title_elem.text().strip()
+
+        price_elem = li.css_first('.s-item__price')
+        if price_elem:
+            price_text = price_elem.text().strip()
+            price_match = re.search(r'\$?([\d,]+(\.\d{2})?)', price_text)
+            if price_match:
+                listing.price = float(price_match.group(1).replace(',', ''))
+
+        url_elem = li.css_first('a.s-item__link')
+        if url_elem:
+            listing.url = url_elem.attributes['href']
+
+        img_elem = li.css_first('img')
+        if img_elem:
+            src = img_elem.attributes.get('src') or img_elem.attributes.get('data-src')
+            if src:
+                listing.image_urls = [src]
 
-        return listing if listing["name"] else None
\ No newline at end of file
+        return listing if listing.name else None
\ No newline at end of file
@@ -0,0 +1,136 @@
+from html.parser import HTMLParser
+
+# Elements that never have an end tag
+VOID_ELEMENTS = frozenset((
+    'area', 'base', 'br', 'col', 'embed', 'hr', 'img', 'input', 'link', 'meta', 'param', 'source', 'track', 'wbr',
+))
+
+
+def has_class(attrs, name):
+    return name in (attrs.get('class') or '').split()
+
+
+class ListingStream(HTMLParser):
+    """Extract listings from HTML fed in chunks, without building a DOM.
+
+    Subclasses say which element holds the results (is_container) and which
+    elements inside it are listings (is_item), and collect a listing's
+    fields from the item_* callbacks. Completed listings wait in ready;
+    once the results container closes, done is set and the rest of the page
+    can go unread.
+
+    The parser hands text over in pieces wherever a chunk ends, so it is
+    buffered and reaches item_data and outside_data whole, at the next tag.
+    """
+
+    def __init__(self):
+        super().__init__(convert_charrefs=True)
+        self.stack = []
+        self.container_depth = None
+        self.item_depth = None
+        self.captures = {}
+        self.fields = {}
+        self.ready = []
+        self.text = []
+        self.done = False
+
+    def is_container(self, tag, attrs):
+        raise NotImplementedError
+
+    def is_item(self, tag, attrs):
+        raise NotImplementedError
+
+    def item_starttag(self, tag, attrs):
+        pass
+
+    def outside_data(self, data):
+        pass
+
+    def build_listing(self, fields):
+        """Return a Listing from the fields collected for one item, or None to skip it."""
+        raise NotImplementedError
+
+    def capture_text(self, field):
+        """Collect the text of the element just opened into fields[field], if not already set."""
+        if field not in self.fields and field not in self.captures:
+            self.captures[field] = (len(self.stack), [])
+
+    def set_field(self, field, value):
+        self.fields.setdefault(field, value)
+
+    def take(self):
+        listings, self.ready = self.ready, []
+        return listings
+
+    def handle_starttag(self, tag, attrs):
+        if self.done:
+            return
+        self._flush_text()
+        attrs = dict(attrs)
+        if self.container_depth is None:
+            if self.is_container(tag, attrs):
+                self.container_depth = len(self.stack)
+        elif self.item_depth is None and self.is_item(tag, attrs):
+            self.item_depth = len(self.stack)
+            self.fields = {}
+            self.captures = {}
+        if self.item_depth is not None:
+            self.item_starttag(tag, attrs)
+        if tag not in VOID_ELEMENTS:
+            self.stack.append(tag)
+
+    def handle_startendtag(self, tag, attrs):
+        if self.done:
+            return
+        self.handle_starttag(tag, attrs)
+        if tag not in VOID_ELEMENTS:
+            self.handle_endtag(tag)
+
+    def handle_endtag(self, tag):
+        if self.done:
+            return
+        self._flush_text()
+        if tag not in self.stack:
+            return
+        # Anything left open inside the element closes with it
+        while self.stack.pop() != tag:
+            pass
+        self._close_captures()
+        depth = len(self.stack)
+        if self.item_depth is not None and depth <= self.item_depth:
+            self.item_depth = None
+            listing = self.build_listing(self.fields)
+            if listing is not None:
+                self.ready.append(listing)
+        if self.container_depth is not None and depth <= self.container_depth:
+            self.done = True
+
+    def handle_data(self, data):
+        if not self.done:
+            self.text.append(data)
+
+    def close(self):
+        super().close()
+        self._flush_text()
+
+    def _flush_text(self):
+        if not self.text:
+            return
+        data = ''.join(self.text)
+        self.text = []
+        if self.item_depth is None:
+            self.outside_data(data)
+            return
+        for _, parts in self.captures.values():
+            parts.append(data)
+        self.item_data(data)
+
+    def item_data(self, data):
+        pass
+
+    def _close_captures(self):
+        depth = len(self.stack)
+        for field, (capture_depth, parts) in list(self.captures.items()):
+            if depth <= capture_depth:
+                del self.captures[field]
+                self.fields.setdefault(field, ''.join(parts))
@@ -0,0 +1,260 @@
+import asyncio
+import hashlib
+import io
+import logging
+import os
+import re
+import sqlite3
+import threading
+import time
+from urllib.parse import quote, urlsplit
+
+from listing import Listing
+import scraper_base
+
+try:
+    from PIL import Image
+except ImportError:
+    Image = None
+
+# Only the listing sites' image CDNs are proxied, never arbitrary URLs
+IMAGE_HOSTS = ('ebayimg.com', 'images.craigslist.org', 'images.offerup.com')
+
+image_headers = {
+    'Accept': 'image/avif,image/webp,image/apng,image/*,*/*;q=0.8',
+    'Sec-Fetch-Dest': 'image',
+    'Sec-Fetch-Mode': 'no-cors',
+    'Sec-Fetch-Site': 'cross-site',
+}
+
+# eBay serves every image at these widths: .../s-l<width>.jpg
+ebay_size = re.compile(r'/s-l\d+\.')
+ebay_widths = (64, 140, 225, 300, 500, 960, 1600)
+
+
+def presized_url(url, size):
+    """The CDN's own rendition of url closest above size pixels, where the host has one."""
+    if urlsplit(url).netloc.endswith('ebayimg.com'):
+        width = next((width for width in ebay_widths if width >= size), ebay_widths[-1])
+        return ebay_size.sub(f'/s-l{width}.', url, count=1)
+    # Craigslist image URLs are built at 300x300 already
+    return url
+
+
+class ImageCache:
+    """Content-addressed disk cache of listing images behind /img/<key>.
+
+    A key is the hash of the image's URL; it maps to the hash of the image
+    bytes, which names the file, so one image reached from several URLs is
+    stored once. The least recently served images are evicted once the
+    files exceed max_bytes.
+    """
+
+    def __init__(self, path, max_bytes=256 * 1024 * 1024, thumbnail_size=300, max_concurrent_fetches=8,
+                 fetch_timeout=10, allowed_hosts=IMAGE_HOSTS, prefetch=True):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.thumbnail_size = thumbnail_size
+        self.fetch_timeout = fetch_timeout
+        self.allowed_hosts = tuple(allowed_hosts)
+        self.prefetch_enabled = prefetch
+        self.max_concurrent_fetches = max_concurrent_fetches
+        # Created on the finder's loop by the first fetch
+        self.fetch_slots = None
+        self.fetches = {}
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.prefetches = 0
+        self.fetched = 0
+        self.errors = 0
+        self.evictions = 0
+        os.makedirs(path, exist_ok=True)
+        self.db = sqlite3.connect(os.path.join(path, 'images.db'), check_same_thread=False, isolation_level=None)
+        self.db.execute('PRAGMA journal_mode=WAL')
+        self.db.execute(
+            'CREATE TABLE IF NOT EXISTS images ('
+            'key TEXT PRIMARY KEY, digest TEXT NOT NULL, content_type TEXT NOT NULL, accessed_at REAL NOT NULL)'
+        )
+        self.db.execute('CREATE INDEX IF NOT EXISTS images_accessed_at ON images (accessed_at)')
+        self.db.execute('CREATE INDEX IF NOT EXISTS images_digest ON images (digest)')
+        self.db.execute('CREATE TABLE IF NOT EXISTS blobs (digest TEXT PRIMARY KEY, size INTEGER NOT NULL)')
+
+    @staticmethod
+    def key(url):
+        return hashlib.sha256(url.encode('utf-8')).hexdigest()[:32]
+
+    def allowed(self, url):
+        parts = urlsplit(url)
+        host = parts.hostname or ''
+        return parts.scheme in ('http', 'https') and \
+            any(host == allowed or host.endswith('.' + allowed) for allowed in self.allowed_hosts)
+
+    def accepts(self, key, url):
+        return bool(url) and self.key(url) == key and self.allowed(url)
+
+    def url_for(self, url):
+        """The /img URL serving url's image, or None if url is not proxied."""
+        if not self.allowed(url):
+            return None
+        return f"/img/{self.key(url)}?src={quote(url, safe='')}"
+
+    def blob_path(self, digest):
+        return os.path.join(self.path, digest[:2], digest)
+
+    def lookup(self, key):
+        """(file path, content type, digest) of a cached image, or None."""
+        with self.lock:
+            row = self.db.execute('SELECT digest, content_type FROM images WHERE key = ?', (key,)).fetchone()
+            if row is None:
+                return None
+            digest, content_type = row
+            path = self.blob_path(digest)
+            if not os.path.exists(path):
+                self.db.execute('DELETE FROM images WHERE key = ?', (key,))
+                return None
+            self.db.execute('UPDATE images SET accessed_at = ? WHERE key = ?', (time.time(), key))
+            return path, content_type, digest
+
+    async def get(self, key, url):
+        """The cached image for url, fetching it on a miss; None when it cannot be had."""
+        image = self.lookup(key)
+        if image:
+            self.hits += 1
+            return image
+        self.misses += 1
+        # A client going away must not cancel a fetch others may be waiting on
+        return await asyncio.shield(self.fetch(key, url))
+
+    def fetch(self, key, url):
+        task = self.fetches.get(key)
+        if task is None:
+            task = self.fetches[key] = asyncio.ensure_future(self._fetch(key, url))
+            task.add_done_callback(lambda _: self.fetches.pop(key, None))
+        return task
+
+    def prefetch(self, listings):
+        """Start fetching the first image of each listing not already cached."""
+        if not self.prefetch_enabled:
+            return
+        for listing in listings:
+            if not isinstance(listing, Listing) or not listing.image_urls:
+                continue
+            url = listing.image_urls[0]
+            key = self.key(url)
+            if key in self.fetches or not self.allowed(url):
+                continue
+            with self.lock:
+                if self.db.execute('SELECT 1 FROM images WHERE key = ?', (key,)).fetchone():
+                    continue
+            self.prefetches += 1
+            self.fetch(key, url)
+
+    async def _fetch(self, key, url):
+        source = presized_url(url, self.thumbnail_size)
+        if self.fetch_slots is None:
+            self.fetch_slots = asyncio.Semaphore(self.max_concurrent_fetches)
+        # Looked up per fetch: configure_session_pool() replaces the pool
+        session_pool = scraper_base.session_pool
+        async with self.fetch_slots:
+            try:
+                response = await session_pool.session(source).get(source, headers=image_headers,
+                                                                  timeout=self.fetch_timeout)
+                session_pool.record(source, response)
+            except Exception as e:
+                self.errors += 1
+                logging.warning(f"Error fetching image {source}: {str(e)}")
+                return None
+        content_type = response.headers.get('Content-Type', '').split(';')[0].strip()
+        if response.status_code != 200 or not content_type.startswith('image/'):
+            self.errors += 1
+            logging.warning(f"Image {source} returned {response.status_code} {content_type}")
+            return None
+        self.fetched += 1
+        # Resizing and file writes stay off the event loop
+        return await asyncio.get_running_loop().run_in_executor(
+            None, self.store, key, response.content, content_type
+        )
+
+    def resize(self, body, content_type):
+        """Scale an image down to thumbnail_size, when Pillow is installed and it is larger."""
+        if Image is None:
+            return body, content_type
+        try:
+            with Image.open(io.BytesIO(body)) as image:
+                if max(image.size) <= self.thumbnail_size:
+                    return body, content_type
+                image_format = image.format
+                image.thumbnail((self.thumbnail_size, self.thumbnail_size))
+                out = io.BytesIO()
+                image.save(out, format=image_format)
+        except Exception as e:
+            logging.warning(f"Error resizing image: {str(e)}")
+            return body, content_type
+        return out.getvalue(), content_type
+
+    def store(self, key, body, content_type):
+        body, content_type = self.resize(body, content_type)
+        digest = hashlib.sha256(body).hexdigest()
+        path = self.blob_path(digest)
+        if not os.path.exists(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            partial = f"{path}.{os.getpid()}.{threading.get_ident()}"
+            with open(partial, 'wb') as f:
+                f.write(body)
+            os.replace(partial, path)
+        with self.lock:
+            self.db.execute('INSERT OR IGNORE INTO blobs (digest, size) VALUES (?, ?)', (digest, len(body)))
+            self.db.execute(
+                'INSERT OR REPLACE INTO images (key, digest, content_type, accessed_at) VALUES (?, ?, ?, ?)',
+                (key, digest, content_type, time.time())
+            )
+            self._evict(keep=digest)
+        return path, content_type, digest
+
+    def _evict(self, keep):
+        # Sized from the table rather than a counter, so worker processes
+        # sharing the directory evict against the same total
+        size = self.db.execute('SELECT COALESCE(SUM(size), 0) FROM blobs').fetchone()[0]
+        while size > self.max_bytes:
+            row = self.db.execute(
+                'SELECT key, digest FROM images WHERE digest != ? ORDER BY accessed_at LIMIT 1', (keep,)
+            ).fetchone()
+            if row is None:
+                return
+            key, digest = row
+            self.db.execute('DELETE FROM images WHERE key = ?', (key,))
+            self.evictions += 1
+            if self.db.execute('SELECT 1 FROM images WHERE digest = ?', (digest,)).fetchone():
+                continue
+            size -= self.db.execute('SELECT size FROM blobs WHERE digest = ?', (digest,)).fetchone()[0]
+            self.db.execute('DELETE FROM blobs WHERE digest = ?', (digest,))
+            try:
+                os.remove(self.blob_path(digest))
+            except FileNotFoundError:
+                pass
+
+    def close(self):
+        for task in list(self.fetches.values()):
+            task.cancel()
+        with self.lock:
+            self.db.close()
+
+    def stats(self):
+        with self.lock:
+            images = self.db.execute('SELECT COUNT(*) FROM images').fetchone()[0]
+            files, size = self.db.execute('SELECT COUNT(*), COALESCE(SUM(size), 0) FROM blobs').fetchone()
+        return {
+            "images": images,
+            "files": files,
+            "bytes": size,
+            "max_bytes": self.max_bytes,
+            "hits": self.hits,
+            "misses": self.misses,
+            "prefetches": self.prefetches,
+            "fetched": self.fetched,
+            "fetching": len(self.fetches),
+            "errors": self.errors,
+            "evictions": self.evictions,
+            "resizing": Image is not None,
+        }
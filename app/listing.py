@@ -0,0 +1,103 @@
+import json
+import sys
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+def dumps(obj):
+    """Compact JSON as bytes, using orjson when it is installed."""
+    if orjson is not None:
+        return orjson.dumps(obj, default=_default)
+    return json.dumps(obj, separators=(',', ':'), default=_default).encode('utf-8')
+
+
+def _default(obj):
+    if isinstance(obj, Listing):
+        return obj.to_item()
+    raise TypeError(f"Object of type {obj.__class__.__name__} is not JSON serializable")
+
+
+# Maps a listing's first image URL to a URL on this server, or None; set by
+# configure_thumbnails() when the image proxy is on
+thumbnail_url = None
+
+
+def configure_thumbnails(url_for):
+    global thumbnail_url
+    thumbnail_url = url_for
+
+
+def source_id(name):
+    # One shared string per source, however many listings (or worker
+    # processes' unpickled copies) refer to it
+    return sys.intern(name)
+
+
+class Listing:
+    __slots__ = ('name', 'price', 'image_urls', 'url', 'source', 'duplicates', '_encoded')
+
+    def __init__(self, name=None, price=None, image_urls=None, url=None, source=None, duplicates=None):
+        self.name = name
+        self.price = price
+        self.image_urls = image_urls or []
+        self.url = url
+        self.source = source
+        self.duplicates = duplicates
+        self._encoded = None
+
+    def __eq__(self, other):
+        if not isinstance(other, Listing):
+            return NotImplemented
+        return (self.name, self.price, self.image_urls, self.url, self.source) == \
+            (other.name, other.price, other.image_urls, other.url, other.source)
+
+    def __repr__(self):
+        return f"Listing(name={self.name!r}, price={self.price!r}, image_urls={self.image_urls!r}, url={self.url!r}, source={self.source!r})"
+
+    def __getstate__(self):
+        return (self.name, self.price, self.image_urls, self.url, self.source, self.duplicates)
+
+    def __setstate__(self, state):
+        self.name, self.price, self.image_urls, self.url, source, self.duplicates = state
+        self.source = source_id(source) if source else None
+        self._encoded = None
+
+    def set_source(self, source):
+        if self.source is not source:
+            self.source = source
+            self._encoded = None
+
+    def with_duplicates(self, others):
+        return Listing(self.name, self.price, self.image_urls, self.url, self.source,
+                       [{"source": other.source, "url": other.url, "price": other.price} for other in others])
+
+    def to_dict(self):
+        data = {"name": self.name, "price": self.price, "image_urls": self.image_urls, "url": self.url}
+        if self.duplicates:
+            data["duplicates"] = self.duplicates
+        if thumbnail_url and self.image_urls:
+            thumbnail = thumbnail_url(self.image_urls[0])
+            if thumbnail:
+                data["thumbnail"] = thumbnail
+        return data
+
+    def to_item(self):
+        return {"type": "result", "source": self.source, "data": self.to_dict()}
+
+    def encode(self):
+        # Listings are not changed once parsed, so the result item is encoded
+        # once and reused by every poll, stream and store write
+        if self._encoded is None:
+            self._encoded = dumps(self.to_item())
+        return self._encoded
+
+
+def encode_item(item):
+    return item.encode() if isinstance(item, Listing) else dumps(item)
+
+
+def encode_items(items):
+    return b'[' + b','.join(encode_item(item) for item in items) + b']'
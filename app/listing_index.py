@@ -0,0 +1,149 @@
+import json
+import logging
+import re
+import sqlite3
+import threading
+import time
+
+from listing import Listing, source_id
+
+WORD = re.compile(r'\w+')
+
+
+class ListingIndex:
+    def __init__(self, path, batch_size=500, flush_interval=1.0):
+        self.path = path
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self.db.execute('PRAGMA journal_mode=WAL')
+        self.db.execute('PRAGMA synchronous=NORMAL')
+        self.db.executescript('''
+            CREATE TABLE IF NOT EXISTS listings (
+                id INTEGER PRIMARY KEY,
+                url TEXT NOT NULL UNIQUE,
+                source TEXT NOT NULL,
+                name TEXT NOT NULL,
+                price REAL,
+                image_urls TEXT NOT NULL,
+                first_seen REAL NOT NULL,
+                last_seen REAL NOT NULL
+            );
+            CREATE INDEX IF NOT EXISTS listings_last_seen ON listings (last_seen);
+            CREATE VIRTUAL TABLE IF NOT EXISTS listings_fts USING fts5(
+                name, content='listings', content_rowid='id', tokenize='porter unicode61'
+            );
+            CREATE TRIGGER IF NOT EXISTS listings_ai AFTER INSERT ON listings BEGIN
+                INSERT INTO listings_fts (rowid, name) VALUES (new.id, new.name);
+            END;
+            CREATE TRIGGER IF NOT EXISTS listings_ad AFTER DELETE ON listings BEGIN
+                INSERT INTO listings_fts (listings_fts, rowid, name) VALUES ('delete', old.id, old.name);
+            END;
+            CREATE TRIGGER IF NOT EXISTS listings_au AFTER UPDATE OF name ON listings BEGIN
+                INSERT INTO listings_fts (listings_fts, rowid, name) VALUES ('delete', old.id, old.name);
+                INSERT INTO listings_fts (rowid, name) VALUES (new.id, new.name);
+            END;
+        ''')
+        self.pending = []
+        self.changed = threading.Condition()
+        self.closed = False
+        self.batches = 0
+        self.written = 0
+        self.dropped = 0
+        self.searches = 0
+        self.writer = threading.Thread(target=self._write_loop, name='listing-index', daemon=True)
+        self.writer.start()
+
+    def add(self, listings):
+        # Writes are batched on the writer thread; listings without a URL
+        # cannot be deduplicated and are skipped
+        with self.changed:
+            self.pending.extend(listing for listing in listings if listing.url and listing.name)
+            if len(self.pending) >= self.batch_size:
+                self.changed.notify()
+
+    def _write_loop(self):
+        while True:
+            with self.changed:
+                if not self.closed and len(self.pending) < self.batch_size:
+                    self.changed.wait(self.flush_interval)
+                batch, self.pending = self.pending, []
+                closed = self.closed
+            if batch:
+                try:
+                    self._write(batch)
+                except Exception as e:
+                    # The index is a cache of what searches found; losing a
+                    # batch beats losing the writer
+                    self.dropped += len(batch)
+                    logging.error(f"Error writing {len(batch)} listings to the index: {str(e)}")
+            if closed:
+                return
+
+    def _write(self, batch):
+        now = time.time()
+        rows = {
+            listing.url: (listing.url, listing.source, listing.name, listing.price,
+                          json.dumps(listing.image_urls), now, now)
+            for listing in batch
+        }
+        with self.lock:
+            self.db.execute('BEGIN')
+            try:
+                self.db.executemany(
+                    'INSERT INTO listings (url, source, name, price, image_urls, first_seen, last_seen) '
+                    'VALUES (?, ?, ?, ?, ?, ?, ?) '
+                    'ON CONFLICT (url) DO UPDATE SET source = excluded.source, name = excluded.name, '
+                    'price = excluded.price, image_urls = excluded.image_urls, last_seen = excluded.last_seen',
+                    rows.values()
+                )
+                self.db.execute('COMMIT')
+            except Exception:
+                self.db.execute('ROLLBACK')
+                raise
+        self.batches += 1
+        self.written += len(rows)
+
+    def search(self, query, limit=200, max_age=None):
+        words = WORD.findall(query)
+        if not words:
+            return []
+        # Quote every word so user input cannot use FTS query syntax
+        match = ' '.join('"' + word.replace('"', '""') + '"' for word in words)
+        since = time.time() - max_age if max_age else 0
+        with self.lock:
+            rows = self.db.execute(
+                'SELECT l.source, l.name, l.price, l.image_urls, l.url FROM listings_fts '
+                'JOIN listings l ON l.id = listings_fts.rowid '
+                'WHERE listings_fts MATCH ? AND l.last_seen >= ? '
+                'ORDER BY bm25(listings_fts) LIMIT ?',
+                (match, since, limit)
+            ).fetchall()
+        self.searches += 1
+        return [
+            Listing(name, price, json.loads(image_urls), url, source_id(source))
+            for source, name, price, image_urls, url in rows
+        ]
+
+    def close(self):
+        with self.changed:
+            self.closed = True
+            self.changed.notify()
+        self.writer.join()
+        with self.lock:
+            self.db.close()
+
+    def stats(self):
+        with self.lock:
+            count = self.db.execute('SELECT COUNT(*) FROM listings').fetchone()[0]
+        with self.changed:
+            pending = len(self.pending)
+        return {
+            "listings": count,
+            "pending_writes": pending,
+            "batches": self.batches,
+            "written": self.written,
+            "dropped": self.dropped,
+            "searches": self.searches,
+        }
@@ -1,93 +1,787 @@
-from flask import Flask, render_template, jsonify
+from flask import Flask, Response, render_template, jsonify, request, stream_with_context
 import asyncio
+import os
+import time
 import uuid
 import logging
-from concurrent.futures import ThreadPoolExecutor
-from queue import Queue
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeoutError
+from queue import Queue, Full
+from scraper_base import (configure_parse_executor, configure_host_limiter, configure_retries,
+                          configure_session_pool, close_sessions, host_stats, keep_sessions_warm, parse_stats,
+                          request_deadline, session_stats)
 from craigslist_scraper import CraigslistScraper
+from craigslist_region_scraper import CraigslistRegionScraper
 from ebay_scraper import EbayScraper
 from offerup_scraper import OfferUpScraper
+from search_cache import SearchCache, normalize_query
+from result_store import MemoryResultStore, SQLiteResultStore, item_fields
+from zmq_server import ZmqSearchServer
+from listing import configure_thumbnails, dumps, encode_item
+from merge import merge_results
+from listing_index import ListingIndex
+from watch import WatchScheduler
+from image_cache import IMAGE_HOSTS, ImageCache
+import broker
+from broker import JobQueue
+import metrics
 
 app = Flask(__name__)
 logging.basicConfig(level=logging.INFO)
 
 class UsedItemsFinder:
-    def __init__(self):
-        self.scrapers = [CraigslistScraper(), EbayScraper(), OfferUpScraper()]
-        self.results = {}
-        self.active_searches = {}
-        self.search_queue = Queue()
+    def __init__(self, max_concurrent_searches=4, max_queue_size=100, cache=None, store=None, parser_backends=None,
+                 craigslist_locations=None, craigslist_max_per_host=4, max_results=None, max_pages=None,
+                 search_deadline=20.0, source_timeout=15.0, source_timeouts=None,
+                 index=None, local_limit=200, local_max_age=None,
+                 watch_interval=300, watch_jitter=0.2, max_concurrent_watches=4, search_queue=None, run_searches=True,
+                 warm_interval=60, images=None, max_batch_size=100, batch_concurrency=16, max_watch_items=1000,
+                 min_watch_interval=30, max_watches=100):
+        parser_backends = parser_backends or {}
+        self.index = index
+        self.images = images
+        self.local_limit = local_limit
+        self.local_max_age = local_max_age
+        self.local_answers = 0
+        self.refreshes = 0
+        self.search_deadline = search_deadline
+        self.source_timeout = source_timeout
+        self.source_timeouts = source_timeouts or {}
+        self.source_timeout_counts = {}
+        self.search_options = {"max_results": max_results, "max_pages": max_pages}
+        self.scrapers = [
+            CraigslistRegionScraper(craigslist_locations, craigslist_max_per_host)
+            if craigslist_locations and len(craigslist_locations) > 1
+            else CraigslistScraper(*(craigslist_locations or [])),
+            EbayScraper(parser_backends.get('EbayScraper', 'bs4')),
+            OfferUpScraper(parser_backends.get('OfferUpScraper', 'bs4'))
+        ]
+        self.cache = cache or SearchCache()
+        self.store = store or MemoryResultStore()
+        # A broker's shared queue when searches run in worker processes;
+        # run_searches is False on the front-ends that only enqueue them
+        self.search_queue = search_queue or Queue(maxsize=max_queue_size)
+        self.run_searches = run_searches
+        self.warm_interval = warm_interval
+        self.max_concurrent_searches = max_concurrent_searches
+        self.max_batch_size = max_batch_size
+        self.batch_concurrency = batch_concurrency
+        self.batches_started = 0
+        self.batch_queries = 0
+        self.search_slots = None
+        self.in_flight = 0
+        self.searches_started = 0
+        self.searches_rejected = 0
+        self.queue_wait_total = 0.0
+        self.queue_wait_max = 0.0
+        self.loop_lag_max = 0.0
+        self.loop_lag_total = 0.0
+        self.loop_lag_samples = 0
         self.loop = asyncio.new_event_loop()
         self.thread = None
+        self.watches = WatchScheduler(self, watch_interval, watch_jitter, max_concurrent_watches,
+                                      min_watch_interval, max_watches)
+        self.max_watch_items = max_watch_items
+
+    def enqueue(self, query, search_id):
+        # Started first: a worker may run the job before put_nowait returns
+        self.store.start(search_id)
+        try:
+            self.search_queue.put_nowait((query, search_id, time.monotonic()))
+        except (Full, asyncio.QueueFull):
+            self.searches_rejected += 1
+            self.store.discard(search_id)
+            return None
+        return self.search_queue.qsize()
+
+    def enqueue_batch(self, queries, batch_id):
+        """Queue queries to run together as one job.
+
+        Returns a (query, search_id) pair for each query, or None when the
+        queue is full. Repeats of a query share its search id.
+        """
+        unique = {}
+        for query in queries:
+            unique.setdefault(normalize_query(query), query)
+        search_ids = {key: f"{batch_id}-{i}" for i, key in enumerate(unique)}
+        # Started first, as in enqueue()
+        for search_id in (batch_id, *search_ids.values()):
+            self.store.start(search_id)
+        try:
+            self.search_queue.put_nowait((list(unique.values()), batch_id, time.monotonic()))
+        except (Full, asyncio.QueueFull):
+            self.searches_rejected += 1
+            for search_id in (batch_id, *search_ids.values()):
+                self.store.discard(search_id)
+            return None
+        return [(query, search_ids[normalize_query(query)]) for query in queries]
+
+    def search_local(self, query, search_id):
+        """Answer from the listing index and refresh the query from live sources in the background.
+
+        Returns the number of indexed listings found, or None when the index
+        has nothing and the search should be queued as usual.
+        """
+        if not self.index:
+            return None
+        listings = self.index.search(query, limit=self.local_limit, max_age=self.local_max_age)
+        if not listings:
+            return None
+        self.store.start(search_id)
+        self.store.add(search_id, listings)
+        self.store.finish(search_id, merge_results(listings, query))
+        self.local_answers += 1
+        asyncio.run_coroutine_threadsafe(self.refresh(query), self.loop)
+        return len(listings)
+
+    def watch(self, query, interval=None):
+        """Save a search; listings it has not seen before stream to /stream/<watch_id>.
+
+        Returns None when there are too many watches; raises ValueError for
+        an invalid interval (see WatchScheduler.add).
+        """
+        watch_id = str(uuid.uuid4())
+        self.store.start(watch_id)
+        try:
+            added = self.watches.add(query, interval, self._watch_found, watch_id=watch_id)
+        except ValueError:
+            self.store.discard(watch_id)
+            raise
+        if added is None:
+            self.store.discard(watch_id)
+        return added
+
+    def _watch_found(self, watch, listings):
+        self.store.add(watch.id, listings)
+        # A watch never finishes; keep only its newest listings
+        self.store.trim(watch.id, self.max_watch_items)
+
+    def unwatch(self, watch_id):
+        self.watches.remove(watch_id)
+        if self.store.is_searching(watch_id):
+            self.store.finish(watch_id)
+
+    async def refresh(self, query):
+        async with self.search_slots:
+            self.refreshes += 1
+            self.in_flight += 1
+            try:
+                # Past the search cache: only live pages reach the index
+                await self.run_sources(query, lambda items: None, fresh=True)
+            except Exception as e:
+                logging.error(f"Error refreshing {query}: {str(e)}")
+            finally:
+                self.in_flight -= 1
+
+    def stats(self):
+        started = self.searches_started
+        return {
+            "queue_depth": self.search_queue.qsize(),
+            "queue_capacity": self.search_queue.maxsize,
+            "in_flight": self.in_flight,
+            "max_concurrent_searches": self.max_concurrent_searches,
+            "searches_started": started,
+            "searches_rejected": self.searches_rejected,
+            "batches_started": self.batches_started,
+            "batch_queries": self.batch_queries,
+            "queue_wait_avg": self.queue_wait_total / started if started else 0.0,
+            "queue_wait_max": self.queue_wait_max,
+            "loop_lag_avg": self.loop_lag_total / self.loop_lag_samples if self.loop_lag_samples else 0.0,
+            "loop_lag_max": self.loop_lag_max,
+            "parse": {source: dict(stats) for source, stats in list(parse_stats.items())},
+            "parser_backends": {scraper.__class__.__name__: scraper.parser_backend for scraper in self.scrapers},
+            "source_timeouts": dict(self.source_timeout_counts),
+            "hosts": self.host_stats(),
+            "connections": session_stats(),
+            "cache": self.cache.stats(),
+            "store": self.store.stats(),
+            "index": dict(self.index.stats(), local_answers=self.local_answers, refreshes=self.refreshes) if self.index else None,
+            "watches": self.watches.stats(),
+            "images": self.images.stats() if self.images else None,
+        }
+
+    def gauges(self):
+        store = self.store.stats()
+        cache = self.cache.stats()
+        hosts = self.host_stats()
+        connections = session_stats()
+        gauges = [
+            ('search_queue_depth', "Searches waiting in the search queue", (), self.search_queue.qsize()),
+            ('search_queue_capacity', "Maximum number of queued searches", (), self.search_queue.maxsize),
+            ('searches_in_flight', "Searches currently running", (), self.in_flight),
+            ('searches_started_total', "Searches started since startup", (), self.searches_started),
+            ('searches_rejected_total', "Searches rejected because the queue was full", (), self.searches_rejected),
+            ('result_store_searches', "Searches held in the result store", ('state',),
+             {('pending',): store['pending'], ('completed',): store['completed']}),
+            ('result_store_bytes', "Serialized size of the result store", (), store['bytes']),
+            ('search_cache_entries', "Entries in the search result cache", (), cache['entries']),
+            ('search_cache_bytes', "Serialized size of the search result cache", (), cache['bytes']),
+            ('host_concurrency_limit', "Adaptive concurrency limit per host", ('host',),
+             {(host,): state['limit'] for host, state in hosts.items()}),
+            ('host_in_flight', "Requests in flight per host", ('host',),
+             {(host,): state['in_flight'] for host, state in hosts.items()}),
+            ('host_rejections_total', "403/429 responses per host", ('host',),
+             {(host,): state['rejections'] for host, state in hosts.items()}),
+            ('http_requests_total', "HTTP requests per host", ('host',),
+             {(host,): counters['requests'] for host, counters in connections.items()}),
+            ('http_connections_reused_total', "HTTP requests sent on a reused connection", ('host',),
+             {(host,): counters['reused'] for host, counters in connections.items()}),
+            ('http_connections_opened_total', "HTTP connections opened per host", ('host',),
+             {(host,): counters['connections'] for host, counters in connections.items()}),
+            ('watches', "Saved searches being polled", (), len(self.watches.watches)),
+        ]
+        if self.images:
+            images = self.images.stats()
+            gauges += [
+                ('image_cache_bytes', "Size of the cached images on disk", (), images['bytes']),
+                ('image_cache_requests_total', "Image proxy requests", ('result',),
+                 {('hit',): images['hits'], ('miss',): images['misses']}),
+            ]
+        return gauges
+
+    def known_urls(self):
+        targets = [target for scraper in self.scrapers for target in getattr(scraper, 'metros', [scraper])]
+        return [url for target in targets for url in (target.base_url, getattr(target, 'api_url', None)) if url]
+
+    def host_stats(self):
+        hosts = host_stats()
+        for scraper in self.scrapers:
+            if scraper.host_limiter:
+                hosts.update(scraper.host_limiter.stats())
+        return hosts
 
     async def search(self, query, search_id):
-        self.active_searches[search_id] = True
+        self.store.start(search_id)
+        results = []
         try:
-            tasks = [scraper.safe_search(query) for scraper in self.scrapers]
-            results = await asyncio.gather(*tasks, return_exceptions=True)
-            self.results[search_id] = []
-            for scraper, result in zip(self.scrapers, results):
-                if isinstance(result, Exception):
-                    logging.error(f"Error in {scraper.__class__.__name__}: {str(result)}")
-                    self.results[search_id].append({
-                        "type": "error",
-                        "source": scraper.__class__.__name__,
-                        "message": f"Error: {str(result)}"
-                    })
-                elif result:
-                    for item in result:
-                        self.results[search_id].append({
-                            "type": "result",
-                            "source": scraper.__class__.__name__,
-                            "data": item
-                        })
-                else:
-                    logging.warning(f"{scraper.__class__.__name__} failed to return results")
+            await self.run_sources(query, lambda items: self.store.add(search_id, items))
         except Exception as e:
             logging.error(f"Error in search: {str(e)}")
         finally:
-            self.active_searches[search_id] = False
+            results = self.merge(query, search_id)
+            self.store.finish(search_id, results)
+        return results
+
+    async def search_batch(self, queries, batch_id):
+        """Run a batch of queries as one search job.
+
+        Each query's results go to the search id enqueue_batch() gave it.
+        The batch's own id gets a query_complete item as each query
+        finishes. Up to batch_concurrency queries run at once, paced only
+        by the per-host limits, after every scraper has done its per-batch
+        setup (session warm-ups, Craigslist search paths) once.
+        """
+        self.store.start(batch_id)
+        self.batches_started += 1
+        self.batch_queries += len(queries)
+        slots = asyncio.Semaphore(self.batch_concurrency)
+
+        async def run(i, query):
+            search_id = f"{batch_id}-{i}"
+            async with slots:
+                results = await self.search(query, search_id)
+            self.store.add(batch_id, [{
+                "type": "query_complete",
+                "query": query,
+                "search_id": search_id,
+                "count": sum(1 for item in results if item_fields(item)[2])
+            }])
+
+        try:
+            prepared = await asyncio.gather(*(scraper.prepare_batch(queries) for scraper in self.scrapers),
+                                            return_exceptions=True)
+            for scraper, result in zip(self.scrapers, prepared):
+                if isinstance(result, Exception):
+                    # Each search retries the setup itself
+                    logging.warning(f"Error preparing batch in {scraper.__class__.__name__}: {str(result)}")
+            await asyncio.gather(*(run(i, query) for i, query in enumerate(queries)))
+        finally:
+            self.store.finish(batch_id)
+
+    def merge(self, query, search_id):
+        _, items = self.store.get(search_id)
+        try:
+            with metrics.merge_duration.time('all'):
+                return merge_results(items, query)
+        except Exception as e:
+            logging.error(f"Error merging results: {str(e)}")
+            return items
+
+    async def stream(self, query):
+        items = asyncio.Queue()
+        done = object()
+
+        async def produce():
+            try:
+                async with self.search_slots:
+                    self.searches_started += 1
+                    self.in_flight += 1
+                    try:
+                        await self.run_sources(query, lambda batch: [items.put_nowait(item) for item in batch])
+                    finally:
+                        self.in_flight -= 1
+            finally:
+                items.put_nowait(done)
+
+        producer = asyncio.ensure_future(produce())
+        try:
+            while True:
+                item = await items.get()
+                if item is done:
+                    break
+                yield item
+        finally:
+            producer.cancel()
+
+    async def run_sources(self, query, emit, fresh=False):
+        deadline = time.monotonic() + self.search_deadline
+        tasks = [self._search_source(scraper, query, emit, deadline, fresh) for scraper in self.scrapers]
+        with metrics.search_duration.time():
+            await asyncio.gather(*tasks)
+
+    async def _search_source(self, scraper, query, emit, deadline, fresh=False):
+        source = scraper.__class__.__name__
+        timeout = min(self.source_timeouts.get(source, self.source_timeout), deadline - time.monotonic())
+        request_deadline.set(time.monotonic() + timeout)
+        emitted = 0
+        timed_out = False
+
+        def emit_page(listings):
+            nonlocal emitted
+            # The shared fetch outlives a timed out source; drop its late pages
+            if timed_out:
+                return
+            emitted += len(listings)
+            with metrics.merge_duration.time(source):
+                emit(listings)
+            if self.images:
+                # Thumbnails download while the rest of the search streams in
+                self.images.prefetch(listings)
+
+        start = time.perf_counter()
+        def on_page(listings):
+            # Only freshly scraped pages reach here, never cached results
+            if self.index:
+                self.index.add(listings)
+            emit_page(listings)
+
+        try:
+            result = await asyncio.wait_for(
+                self.cache.fetch(scraper, query, on_page=on_page, fresh=fresh, **self.search_options),
+                max(timeout, 0)
+            )
+        except asyncio.TimeoutError:
+            metrics.source_duration.observe(time.perf_counter() - start, source, 'timeout')
+            timed_out = True
+            self.source_timeout_counts[source] = self.source_timeout_counts.get(source, 0) + 1
+            logging.warning(f"{source} timed out after {timeout:.1f}s")
+            emit([{
+                "type": "error",
+                "source": source,
+                "timed_out": True,
+                "message": f"Timed out after {timeout:.1f}s"
+            }])
+            return
+        except Exception as e:
+            metrics.source_duration.observe(time.perf_counter() - start, source, 'error')
+            logging.error(f"Error in {source}: {str(e)}")
+            emit([{
+                "type": "error",
+                "source": source,
+                "message": f"Error: {str(e)}"
+            }])
+            return
+        metrics.source_duration.observe(time.perf_counter() - start, source, 'ok' if result else 'empty')
+        if result:
+            # Pages already streamed come first; cached or coalesced results
+            # arrive here all at once
+            if len(result) > emitted:
+                emit_page(result[emitted:])
+        else:
+            logging.warning(f"{source} failed to return results")
 
     async def process_queue(self):
         while True:
-            query, search_id = await self.loop.run_in_executor(None, self.search_queue.get)
-            await self.search(query, search_id)
+            await self.search_slots.acquire()
+            if isinstance(self.search_queue, asyncio.Queue):
+                query, search_id, enqueued_at = await self.search_queue.get()
+            else:
+                job = await self.loop.run_in_executor(None, self.search_queue.get)
+                if job is None:
+                    return
+                query, search_id, enqueued_at = job
+            waited = time.monotonic() - enqueued_at
+            self.queue_wait_total += waited
+            self.queue_wait_max = max(self.queue_wait_max, waited)
+            metrics.queue_wait.observe(waited)
+            self.searches_started += 1
+            self.loop.create_task(self._run_search(query, search_id))
+
+    async def _run_search(self, query, search_id):
+        self.in_flight += 1
+        try:
+            # A batch job carries its list of queries
+            if isinstance(query, list):
+                await self.search_batch(query, search_id)
+            else:
+                await self.search(query, search_id)
+        finally:
+            self.in_flight -= 1
+            self.search_slots.release()
             self.search_queue.task_done()
 
+    async def monitor_loop_lag(self, interval=0.1):
+        while True:
+            start = time.monotonic()
+            await asyncio.sleep(interval)
+            lag = time.monotonic() - start - interval
+            self.loop_lag_total += lag
+            self.loop_lag_samples += 1
+            self.loop_lag_max = max(self.loop_lag_max, lag)
+
+    def start_tasks(self):
+        self.search_slots = asyncio.Semaphore(self.max_concurrent_searches)
+        if self.run_searches:
+            self.loop.create_task(self.process_queue())
+        self.loop.create_task(self.monitor_loop_lag())
+        self.loop.create_task(self.watches.run())
+        if self.warm_interval and self.run_searches:
+            self.loop.create_task(keep_sessions_warm(self.known_urls, self.warm_interval))
+
     def start_background_loop(self):
         asyncio.set_event_loop(self.loop)
-        self.loop.create_task(self.process_queue())
+        self.start_tasks()
         self.loop.run_forever()
 
     def start(self):
         if not self.thread:
             self.thread = ThreadPoolExecutor(max_workers=1).submit(self.start_background_loop)
 
+    def start_native(self):
+        """Run on the calling thread's running loop, as the ASGI server does.
+
+        Requests are then handled on the same loop as the searches, and
+        searches are dispatched through an asyncio.Queue instead of a
+        thread-blocking one.
+        """
+        self.loop.close()
+        self.loop = asyncio.get_running_loop()
+        if isinstance(self.search_queue, Queue):
+            self.search_queue = asyncio.Queue(maxsize=self.search_queue.maxsize)
+        self.start_tasks()
+
     def stop(self):
-        self.loop.call_soon_threadsafe(self.loop.stop)
+        if isinstance(self.search_queue, JobQueue):
+            self.search_queue.close()
         if self.thread:
+            # Close pooled connections on the loop that opened them
+            try:
+                asyncio.run_coroutine_threadsafe(close_sessions(), self.loop).result(timeout=5)
+            except Exception as e:
+                logging.warning(f"Error closing sessions: {str(e)}")
+            self.loop.call_soon_threadsafe(self.loop.stop)
             self.thread.result()
+            # Wake the executor thread blocked in search_queue.get so the process can exit
+            if isinstance(self.search_queue, Queue):
+                try:
+                    self.search_queue.put_nowait(None)
+                except Full:
+                    pass
+        self.store.close()
+        if self.index:
+            self.index.close()
+        if self.images:
+            self.images.close()
+
+configure_parse_executor(
+    os.environ.get('PARSE_EXECUTOR') or None,
+    int(os.environ['PARSE_WORKERS']) if os.environ.get('PARSE_WORKERS') else None
+)
+
+configure_retries(
+    max_retries=int(os.environ.get('REQUEST_RETRIES', 2)),
+    backoff=float(os.environ.get('RETRY_BACKOFF', 0.25)),
+    hedge=os.environ.get('HEDGE_REQUESTS', '').lower() in ('1', 'true', 'yes')
+)
+
+configure_host_limiter(
+    rate=float(os.environ['HOST_RATE']) if os.environ.get('HOST_RATE') else None,
+    burst=int(os.environ.get('HOST_BURST', 4)),
+    max_concurrency=int(os.environ.get('HOST_MAX_CONCURRENCY', 8)),
+    host_rates={
+        host: float(rate)
+        for host, _, rate in (entry.partition('=') for entry in os.environ.get('HOST_RATES', '').split(','))
+        if rate
+    }
+)
+
+configure_session_pool(
+    max_connections=int(os.environ.get('HTTP_MAX_CONNECTIONS', 8)),
+    http2=os.environ.get('HTTP2', 'true').lower() in ('1', 'true', 'yes'),
+    dns_cache_ttl=int(os.environ.get('DNS_CACHE_TTL', 600)),
+    max_idle=int(os.environ.get('HTTP_MAX_IDLE', 120))
+)
+
+# With a BROKER_URL, searches run in worker processes (SERVER_MODE=worker,
+# see worker.py) and every process shares the broker's queue and store
+job_queue, shared_store = broker.connect(
+    os.environ['BROKER_URL'],
+    max_queue_size=int(os.environ.get('MAX_QUEUE_SIZE', 100)),
+    ttl=int(os.environ.get('RESULT_TTL', 600))
+) if os.environ.get('BROKER_URL') else (None, None)
 
-finder = UsedItemsFinder()
-finder.start()
+finder = UsedItemsFinder(
+    max_concurrent_searches=int(os.environ.get('MAX_CONCURRENT_SEARCHES', 4)),
+    max_queue_size=int(os.environ.get('MAX_QUEUE_SIZE', 100)),
+    search_queue=job_queue,
+    run_searches=not job_queue or os.environ.get('SERVER_MODE') == 'worker',
+    cache=SearchCache(
+        default_ttl=int(os.environ.get('CACHE_TTL', 300)),
+        ttls={
+            'CraigslistScraper': int(os.environ.get('CRAIGSLIST_CACHE_TTL', 600)),
+            'CraigslistRegionScraper': int(os.environ.get('CRAIGSLIST_CACHE_TTL', 600)),
+            'EbayScraper': int(os.environ.get('EBAY_CACHE_TTL', 300)),
+            'OfferUpScraper': int(os.environ.get('OFFERUP_CACHE_TTL', 300)),
+        },
+        max_entries=int(os.environ.get('CACHE_MAX_ENTRIES', 1000)),
+        max_bytes=int(os.environ.get('CACHE_MAX_BYTES', 64 * 1024 * 1024))
+    ),
+    store=shared_store or (SQLiteResultStore(
+        os.environ['RESULT_STORE_PATH'],
+        ttl=int(os.environ.get('RESULT_TTL', 3600))
+    ) if os.environ.get('RESULT_STORE_PATH') else MemoryResultStore(
+        ttl=int(os.environ.get('RESULT_TTL', 600)),
+        max_entries=int(os.environ.get('RESULT_MAX_ENTRIES', 1000)),
+        max_bytes=int(os.environ.get('RESULT_MAX_BYTES', 128 * 1024 * 1024))
+    )),
+    parser_backends={
+        'EbayScraper': os.environ.get('EBAY_PARSER') or os.environ.get('PARSER_BACKEND', 'selectolax'),
+        'OfferUpScraper': os.environ.get('OFFERUP_PARSER') or os.environ.get('PARSER_BACKEND', 'selectolax'),
+    },
+    craigslist_locations=[location.strip() for location in os.environ.get('CRAIGSLIST_LOCATIONS', 'chicago').split(',') if location.strip()],
+    craigslist_max_per_host=int(os.environ.get('CRAIGSLIST_MAX_PER_HOST', 4)),
+    max_results=int(os.environ['MAX_RESULTS']) if os.environ.get('MAX_RESULTS') else None,
+    max_pages=int(os.environ['MAX_PAGES']) if os.environ.get('MAX_PAGES') else None,
+    index=ListingIndex(
+        os.environ['LISTING_INDEX_PATH'],
+        batch_size=int(os.environ.get('INDEX_BATCH_SIZE', 500)),
+        flush_interval=float(os.environ.get('INDEX_FLUSH_INTERVAL', 1))
+    ) if os.environ.get('LISTING_INDEX_PATH') else None,
+    local_limit=int(os.environ.get('LOCAL_RESULT_LIMIT', 200)),
+    local_max_age=int(os.environ['LOCAL_MAX_AGE']) if os.environ.get('LOCAL_MAX_AGE') else None,
+    search_deadline=float(os.environ.get('SEARCH_DEADLINE', 20)),
+    source_timeout=float(os.environ.get('SOURCE_TIMEOUT', 15)),
+    watch_interval=float(os.environ.get('WATCH_INTERVAL', 300)),
+    watch_jitter=float(os.environ.get('WATCH_JITTER', 0.2)),
+    max_concurrent_watches=int(os.environ.get('MAX_CONCURRENT_WATCHES', 4)),
+    max_watch_items=int(os.environ.get('WATCH_MAX_ITEMS', 1000)),
+    min_watch_interval=float(os.environ.get('WATCH_MIN_INTERVAL', 30)),
+    max_watches=int(os.environ.get('MAX_WATCHES', 100)),
+    warm_interval=float(os.environ.get('WARM_INTERVAL', 60)),
+    max_batch_size=int(os.environ.get('MAX_BATCH_SIZE', 100)),
+    batch_concurrency=int(os.environ.get('BATCH_CONCURRENCY', 16)),
+    images=ImageCache(
+        os.environ['IMAGE_CACHE_DIR'],
+        max_bytes=int(os.environ.get('IMAGE_CACHE_MAX_BYTES', 256 * 1024 * 1024)),
+        thumbnail_size=int(os.environ.get('THUMBNAIL_SIZE', 300)),
+        max_concurrent_fetches=int(os.environ.get('IMAGE_MAX_CONCURRENT_FETCHES', 8)),
+        allowed_hosts=[host.strip() for host in os.environ['IMAGE_HOSTS'].split(',') if host.strip()]
+        if os.environ.get('IMAGE_HOSTS') else IMAGE_HOSTS,
+        prefetch=os.environ.get('IMAGE_PREFETCH', 'true').lower() in ('1', 'true', 'yes')
+    ) if os.environ.get('IMAGE_CACHE_DIR') else None,
+    source_timeouts={
+        'CraigslistScraper': float(os.environ.get('CRAIGSLIST_TIMEOUT') or os.environ.get('SOURCE_TIMEOUT', 15)),
+        'CraigslistRegionScraper': float(os.environ.get('CRAIGSLIST_TIMEOUT') or os.environ.get('SOURCE_TIMEOUT', 15)),
+        'EbayScraper': float(os.environ.get('EBAY_TIMEOUT') or os.environ.get('SOURCE_TIMEOUT', 15)),
+        'OfferUpScraper': float(os.environ.get('OFFERUP_TIMEOUT') or os.environ.get('SOURCE_TIMEOUT', 15)),
+    }
+)
+# Result items link their first image through /img on this server
+if finder.images:
+    configure_thumbnails(finder.images.url_for)
+
+zmq_server = ZmqSearchServer(finder, os.environ.get('ZMQ_BIND', 'tcp://*:5555')) \
+    if os.environ.get('ZMQ_BIND', 'tcp://*:5555') and os.environ.get('SERVER_MODE') != 'worker' else None
+
+# SERVER_MODE=asgi leaves starting the finder to asgi.py, on the ASGI server's loop
+if os.environ.get('SERVER_MODE', 'flask') == 'flask':
+    finder.start()
+    if zmq_server:
+        asyncio.run_coroutine_threadsafe(zmq_server.serve(), finder.loop)
 
 @app.route('/')
 def index():
     return render_template('index.html')
 
+# Route bodies shared by the Flask routes and asgi.py; each returns
+# (status, response dict or encoded JSON, headers)
+
+def start_search(query, mode=None):
+    search_id = str(uuid.uuid4())
+    if mode == 'local':
+        found = finder.search_local(query, search_id)
+        if found is not None:
+            return 200, {"message": "Answered from local index", "search_id": search_id, "local_results": found}, {}
+    position = finder.enqueue(query, search_id)
+    if position is None:
+        return 429, {"message": "Search queue is full, try again later"}, {"Retry-After": "1"}
+    return 200, {"message": "Search queued", "search_id": search_id, "queue_position": position}, {}
+
+def start_batch(body):
+    queries = body.get('queries') if isinstance(body, dict) else None
+    if not isinstance(queries, list) or not queries or \
+            not all(isinstance(query, str) and query.strip() for query in queries):
+        return 400, {"message": "Expected a JSON body with a non-empty list of queries"}, {}
+    if len(queries) > finder.max_batch_size:
+        return 400, {"message": f"At most {finder.max_batch_size} queries per batch"}, {}
+    batch_id = str(uuid.uuid4())
+    searches = finder.enqueue_batch(queries, batch_id)
+    if searches is None:
+        return 429, {"message": "Search queue is full, try again later"}, {"Retry-After": "1"}
+    return 200, {
+        "message": "Batch queued",
+        "batch_id": batch_id,
+        "stream": f"/stream/{batch_id}",
+        "searches": [{"query": query, "search_id": search_id} for query, search_id in searches],
+    }, {}
+
+def start_watch(query, interval):
+    try:
+        watch_id = finder.watch(query, float(interval) if interval is not None else None)
+    except ValueError:
+        return 400, {"message": "interval must be a positive number of seconds"}, {}
+    if watch_id is None:
+        return 429, {"message": f"At most {finder.watches.max_watches} watches can be active"}, {}
+    return 200, {"message": "Watch started", "watch_id": watch_id, "stream": f"/stream/{watch_id}"}, {}
+
+RESULT_QUERY_ARGS = ('min_price', 'max_price', 'source', 'sort', 'limit', 'offset', 'since')
+
+def query_results(search_id, args):
+    if not any(arg in args for arg in RESULT_QUERY_ARGS):
+        # Splice the encoded results in rather than decoding and re-encoding them
+        is_searching, results = finder.store.get_encoded(search_id)
+        return 200, b'{"is_searching":%s,"results":%s,"search_id":%s}' % (
+            b'true' if is_searching else b'false', results, dumps(search_id)
+        ), {}
+
+    sort = args.get('sort', 'relevance')
+    if sort not in ('relevance', 'price', '-price'):
+        return 400, {"message": "sort must be one of relevance, price, -price"}, {}
+    limit = args.get('limit', type=int)
+    offset = args.get('offset', 0, type=int)
+    if (limit is not None and limit < 0) or offset < 0:
+        return 400, {"message": "limit and offset must not be negative"}, {}
+    sources = args.get('source')
+    try:
+        is_searching, results, cursor, reset = finder.store.query(
+            search_id,
+            min_price=args.get('min_price', type=float),
+            max_price=args.get('max_price', type=float),
+            sources={source.strip() for source in sources.split(',')} if sources else None,
+            sort=sort,
+            since=args.get('since'),
+            limit=limit,
+            offset=offset
+        )
+    except ValueError:
+        return 400, {"message": "Invalid cursor"}, {}
+    return 200, b'{"cursor":%s,"is_searching":%s,"reset":%s,"results":%s,"search_id":%s}' % (
+        dumps(cursor), b'true' if is_searching else b'false', b'true' if reset else b'false', results, dumps(search_id)
+    ), {}
+
+IMAGE_CACHE_CONTROL = 'public, max-age=31536000, immutable'
+
+def check_image(key, src):
+    """The error response for an /img request that will not be served, or None."""
+    if not finder.images:
+        return 404, {"message": "Image proxy is disabled"}, {}
+    if not finder.images.accepts(key, src):
+        return 404, {"message": "Unknown image"}, {}
+    return None
+
+def image_response(image, if_none_match=None):
+    """(status, body, headers, content type) for an ImageCache.get() result."""
+    if image is None:
+        return 502, dumps({"message": "Image could not be fetched"}), {}, 'application/json'
+    path, content_type, digest = image
+    # The key names one URL's image for good, so browsers need never ask again
+    headers = {"Cache-Control": IMAGE_CACHE_CONTROL, "ETag": f'"{digest}"'}
+    if if_none_match == headers["ETag"]:
+        return 304, b'', headers, content_type
+    with open(path, 'rb') as f:
+        return 200, f.read(), headers, content_type
+
+def flask_response(status, body, headers):
+    if isinstance(body, bytes):
+        return Response(body, status=status, headers=headers, mimetype='application/json')
+    return jsonify(body), status, headers
+
 @app.route('/search/<query>')
 def search(query):
-    search_id = str(uuid.uuid4())
-    finder.search_queue.put((query, search_id))
-    return jsonify({"message": "Search queued", "search_id": search_id})
+    return flask_response(*start_search(query, request.args.get('mode')))
+
+@app.route('/batch', methods=['POST'])
+def batch():
+    return flask_response(*start_batch(request.get_json(silent=True)))
+
+@app.route('/watch/<query>')
+def watch(query):
+    return flask_response(*start_watch(query, request.args.get('interval')))
+
+@app.route('/unwatch/<watch_id>')
+def unwatch(watch_id):
+    finder.unwatch(watch_id)
+    return jsonify({"message": "Watch stopped", "watch_id": watch_id})
+
+def search_complete_event(search_id, count):
+    # Streamed items arrive unranked; the merged, ranked results are at /results
+    return b'event: search_complete\ndata: ' + dumps({
+        "search_id": search_id, "count": count, "results": f"/results/{search_id}"
+    }) + b'\n\n'
+
+@app.route('/stream/<search_id>')
+def stream_results(search_id):
+    def generate():
+        offset = 0
+        while True:
+            is_searching, items, offset = finder.store.wait(search_id, offset, timeout=15)
+            for item in items:
+                yield b'data: ' + encode_item(item) + b'\n\n'
+            if not is_searching:
+                yield search_complete_event(search_id, offset)
+                return
+            if not items:
+                yield ": keep-alive\n\n"
+
+    return Response(stream_with_context(generate()), mimetype='text/event-stream', headers={
+        'Cache-Control': 'no-cache',
+        'X-Accel-Buffering': 'no'
+    })
+
+@app.route('/img/<key>')
+def image(key):
+    src = request.args.get('src')
+    error = check_image(key, src)
+    if error:
+        return flask_response(*error)
+    try:
+        found = asyncio.run_coroutine_threadsafe(finder.images.get(key, src), finder.loop) \
+            .result(timeout=finder.images.fetch_timeout * 3)
+    except FutureTimeoutError:
+        found = None
+    status, body, headers, content_type = image_response(found, request.headers.get('If-None-Match'))
+    return Response(body, status=status, headers=headers, mimetype=content_type)
+
+@app.route('/stats')
+def stats():
+    return jsonify(finder.stats())
+
+@app.route('/metrics')
+def prometheus_metrics():
+    return Response(metrics.render(finder.gauges()), mimetype='text/plain; version=0.0.4')
 
 @app.route('/results/<search_id>')
 def get_results(search_id):
-    return jsonify({
-        "is_searching": finder.active_searches.get(search_id, False),
-        "results": finder.results.get(search_id, []),
-        "search_id": search_id
-    })
+    return flask_response(*query_results(search_id, request.args))
 
 if __name__ == "__main__":
     try:
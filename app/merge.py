@@ -0,0 +1,143 @@
+import re
+from collections import defaultdict
+from itertools import combinations
+
+from listing import Listing
+
+TOKEN = re.compile(r'[a-z0-9]+')
+STOPWORDS = frozenset(('a', 'an', 'and', 'the', 'for', 'with', 'of', 'in', 'on', 'to', 'new', 'listing', 'used', 'sale'))
+
+# Bottom-k sketch of the title tokens: each pair of a title's smallest
+# token hashes is an LSH key, and two listings become candidates when they
+# share a key. Near-duplicate titles share most of their smallest hashes.
+SKETCH_SIZE = 3
+
+SIMILARITY = 0.6
+PRICE_TOLERANCE = 0.15
+MAX_REPRESENTATIVES = 4
+
+
+def tokens(text):
+    if not text:
+        return frozenset()
+    # Crude plural folding is enough to match "bikes" with "bike", while
+    # "glass" and "gas" stay whole
+    return frozenset([word[:-1] if word[-1] == 's' and len(word) > 3 and word[-2] != 's' else word
+                      for word in TOKEN.findall(text.lower())]) - STOPWORDS
+
+
+def sketch_keys(token_set):
+    smallest = sorted(map(hash, token_set))[:SKETCH_SIZE]
+    if len(smallest) == 1:
+        return smallest
+    return list(combinations(smallest, 2))
+
+
+def similar_price(a, b):
+    if a is None or b is None:
+        return True
+    return abs(a - b) <= PRICE_TOLERANCE * max(a, b, 1)
+
+
+def group_duplicates(listings, token_sets=None):
+    """Group near-duplicate listings; returns lists of indexes into listings."""
+    parent = list(range(len(listings)))
+
+    def find(i):
+        while parent[i] != i:
+            parent[i] = parent[parent[i]]
+            i = parent[i]
+        return i
+
+    def union(i, j):
+        i, j = find(i), find(j)
+        if i != j:
+            parent[max(i, j)] = min(i, j)
+
+    if token_sets is None:
+        token_sets = [tokens(listing.name) for listing in listings]
+    buckets = defaultdict(list)
+    exact = {}
+    images = {}
+    for i, (listing, token_set) in enumerate(zip(listings, token_sets)):
+        # The same image is the same item, whatever the title says
+        if listing.image_urls:
+            j = images.setdefault(listing.image_urls[0], i)
+            if j != i:
+                union(i, j)
+        if not token_set:
+            continue
+
+        # Identical titles are by far the most common duplicates
+        j = exact.get(token_set)
+        if j is not None and similar_price(listings[j].price, listing.price):
+            union(j, i)
+            continue
+        exact.setdefault(token_set, i)
+
+        # Compare against a few representatives of each bucket we land in,
+        # not every member, to stay linear when many titles collide
+        matched = False
+        for key in sketch_keys(token_set):
+            representatives = buckets[key]
+            for j in representatives:
+                if matched:
+                    break
+                a, b = token_sets[j], token_set
+                if SIMILARITY * max(len(a), len(b)) <= min(len(a), len(b)) and \
+                        len(a & b) >= SIMILARITY * len(a | b) and \
+                        similar_price(listings[j].price, listing.price):
+                    union(j, i)
+                    matched = True
+            if not matched and len(representatives) < MAX_REPRESENTATIVES:
+                representatives.append(i)
+
+    groups = defaultdict(list)
+    for i in range(len(listings)):
+        groups[find(i)].append(i)
+    return list(groups.values())
+
+
+def relevance(query_tokens, listing_tokens):
+    if not query_tokens:
+        return 0.0
+    return len(query_tokens & listing_tokens) / len(query_tokens)
+
+
+def rank(listings, query, token_sets=None):
+    """Order listings by query-term relevance, then by price relative to the median."""
+    if token_sets is None:
+        token_sets = [tokens(listing.name) for listing in listings]
+    query_tokens = tokens(query)
+    prices = sorted(listing.price for listing in listings if listing.price)
+    median = prices[len(prices) // 2] if prices else None
+
+    def score(entry):
+        listing, token_set = entry
+        price_penalty = min(listing.price / median, 3.0) / 10 if median and listing.price else 0.0
+        return relevance(query_tokens, token_set) - price_penalty
+
+    return [listing for listing, _ in sorted(zip(listings, token_sets), key=score, reverse=True)]
+
+
+def merge_results(items, query):
+    """Collapse near-duplicate listings across sources and rank them.
+
+    Each group keeps its first listing, which records where the others were
+    seen. Items that are not listings, such as source errors, go last.
+    """
+    listings = [item for item in items if isinstance(item, Listing)]
+    others = [item for item in items if not isinstance(item, Listing)]
+
+    token_sets = [tokens(listing.name) for listing in listings]
+
+    merged = []
+    merged_tokens = []
+    for group in group_duplicates(listings, token_sets):
+        keep = listings[group[0]]
+        if len(group) > 1:
+            # Listings can be shared with the search cache, so annotate a copy
+            keep = keep.with_duplicates([listings[i] for i in group[1:]])
+        merged.append(keep)
+        merged_tokens.append(token_sets[group[0]])
+    return rank(merged, query, merged_tokens) + others
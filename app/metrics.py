@@ -0,0 +1,95 @@
+import threading
+import time
+from bisect import bisect_left
+from contextlib import contextmanager
+
+DEFAULT_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+
+def escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def format_labels(names, values):
+    if not names:
+        return ''
+    return '{' + ','.join(f'{name}="{escape(value)}"' for name, value in zip(names, values)) + '}'
+
+
+class Histogram:
+    def __init__(self, name, help, labels=(), buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self.buckets = tuple(buckets)
+        self.series = {}
+        self.lock = threading.Lock()
+
+    def observe(self, value, *label_values):
+        with self.lock:
+            series = self.series.get(label_values)
+            if series is None:
+                # Per-bucket counts, then sum and count
+                series = self.series[label_values] = [[0] * len(self.buckets), 0.0, 0]
+            index = bisect_left(self.buckets, value)
+            if index < len(self.buckets):
+                series[0][index] += 1
+            series[1] += value
+            series[2] += 1
+
+    @contextmanager
+    def time(self, *label_values):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, *label_values)
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+        with self.lock:
+            series = [(values, list(counts), total, count) for values, (counts, total, count) in self.series.items()]
+        for values, counts, total, count in sorted(series):
+            cumulative = 0
+            for bound, bucket in zip(self.buckets, counts):
+                cumulative += bucket
+                lines.append(f"{self.name}_bucket{format_labels(self.labels + ('le',), values + (bound,))} {cumulative}")
+            lines.append(f"{self.name}_bucket{format_labels(self.labels + ('le',), values + ('+Inf',))} {count}")
+            lines.append(f"{self.name}_sum{format_labels(self.labels, values)} {total}")
+            lines.append(f"{self.name}_count{format_labels(self.labels, values)} {count}")
+        return lines
+
+
+def render_gauges(gauges):
+    """Render (name, help, label names, value) gauges; labelled ones map label values to a value.
+
+    Series named *_total are running totals and are typed as counters.
+    """
+    lines = []
+    for name, help, labels, values in gauges:
+        lines.append(f"# HELP {name} {help}")
+        lines.append(f"# TYPE {name} {'counter' if name.endswith('_total') else 'gauge'}")
+        if labels:
+            for label_values, value in values.items():
+                lines.append(f"{name}{format_labels(labels, label_values)} {value}")
+        else:
+            lines.append(f"{name} {values}")
+    return lines
+
+
+queue_wait = Histogram('search_queue_wait_seconds', "Time a search waited in the search queue")
+search_duration = Histogram('search_duration_seconds', "End-to-end time to run a search across all sources")
+source_duration = Histogram('source_duration_seconds', "Time to get one source's results", ('source', 'outcome'))
+http_request = Histogram('http_request_duration_seconds', "HTTP request timings by stage", ('source', 'host', 'stage'))
+parse_duration = Histogram('parse_duration_seconds', "Time to extract listings from a response", ('source',))
+merge_duration = Histogram('merge_duration_seconds', "Time to build result items and hand them to the store or stream", ('source',))
+
+histograms = [queue_wait, search_duration, source_duration, http_request, parse_duration, merge_duration]
+
+
+def render(gauges=()):
+    lines = []
+    for histogram in histograms:
+        lines.extend(histogram.render())
+    lines.extend(render_gauges(gauges))
+    return '\n'.join(lines) + '\n'
@@ -1,22 +1,79 @@
-from scraper_base import ScraperBase
+from scraper_base import ScraperBase, LexborHTMLParser
+from listing import Listing
+from html_stream import ListingStream, has_class
 from bs4 import BeautifulSoup as bs
 import re
 
-class OfferUpScraper(ScraperBase):
+class OfferUpListingStream(ListingStream):
     def __init__(self):
         super().__init__()
+        self.after_heading = False
+
+    def is_container(self, tag, attrs):
+        # The first <ul> after the "Current listings" heading
+        return tag == 'ul' and self.after_heading
+
+    def outside_data(self, data):
+        if self.stack and self.stack[-1] == 'h2' and data == 'Current listings':
+            self.after_heading = True
+
+    def is_item(self, tag, attrs):
+        return tag == 'li'
+
+    def item_starttag(self, tag, attrs):
+        if tag == 'span' and has_class(attrs, 'MuiTypography-subtitle1'):
+            self.capture_text('name')
+        if tag == 'a':
+            self.set_field('href', attrs.get('href'))
+        if tag == 'img':
+            self.set_field('src', attrs.get('src'))
+
+    def item_data(self, data):
+        if '$' in data:
+            self.set_field('price', data)
+
+    def build_listing(self, fields):
+        listing = Listing()
+        listing.name = fields.get('name', '').strip() or None
+        price_match = re.search(r'\$?([\d,]+(\.\d{2})?)', fields.get('price', ''))
+        if price_match:
+            listing.price = float(price_match.group(1).replace(',', ''))
+        if fields.get('href') is not None:
+            listing.url = "https://offerup.com" + fields['href']
+        if fields.get('src') is not None:
+            listing.image_urls = [fields['src']]
+        return listing if listing.name else None
+
+class OfferUpScraper(ScraperBase):
+    listing_stream = OfferUpListingStream
+
+    def __init__(self, parser_backend='bs4'):
+        super().__init__(parser_backend)
         self.base_url = "https://offerup.com/search?q="
 
-    async def search(self, query):
-        response = await self.get(self.base_url + query)
+    async def search(self, query, max_results=None, max_pages=None, on_page=None):
+        return await self.search_pages(query, max_results, max_pages, on_page)
+
+    async def fetch_page(self, query, page, on_listings=None):
+        # Further results are loaded by the client-side app, the server
+        # rendered page is the only one there is
+        url = self.base_url + query
+        if self.parser_backend == 'stream':
+            return (await self.fetch_streamed(url, on_listings=on_listings))[0], 1
+        response, cached = await self.conditional_get(url)
+        if cached is not None:
+            return cached
 
         if response.status_code == 200:
-            return self._extract_listings(response.text)
+            result = await self.parse(self.extractor(), response.content), 1
+            self.remember(response, url, None, result)
+            return result
         else:
             print(f"Error: Status code {response.status_code}")
-            return []
+            return [], 0
     
-    def _extract_listings(self, html):
+    @classmethod
+    def _extract_listings(cls, html):
         soup = bs(html, 'html.parser')
         listings = []
 
@@ -26,36 +83,81 @@ class OfferUpScraper(ScraperBase):
             
             if listings_container:
                 for li in listings_container.find_all('li'):
-                    listing = self._parse_listing(li)
+                    listing = cls._parse_listing(li)
                     if listing:
                         listings.append(listing)
 
         return listings
 
-    def _parse_listing(self, li):
-        listing = {
-            "name": None,
-            "price": None,
-            "image_urls": [],
-            "url": None
-        }
+    @classmethod
+    def _extract_listings_selectolax(cls, html):
+        tree = LexborHTMLParser(html)
+        listings = []
+
+        # Equivalent of find('h2', string=...).find_next('ul'): the first <ul>
+        # after the heading in document order
+        listings_container = None
+        found_heading = False
+        for node in tree.root.traverse():
+            if found_heading and node.tag == 'ul':
+                listings_container = node
+                break
+            if node.tag == 'h2' and node.text() == 'Current listings':
+                found_heading = True
+
+        if listings_container:
+            for li in listings_container.css('li'):
+                listing = cls._parse_listing_selectolax(li)
+                if listing:
+                    listings.append(listing)
+
+        return listings
+
+    @staticmethod
+    def _parse_listing(li):
+        listing = Listing()
 
         title_span = li.find('span', class_='MuiTypography-subtitle1')
         if title_span:
-            listing["name"] = title_span.text.strip()
+            listing.name = title_span.text.strip()
 
         price_span = li.find(string=re.compile(r'\$'))
         if price_span:
             price_match = re.search(r'\$?([\d,]+(\.\d{2})?)', price_span)
             if price_match:
-                listing["price"] = float(price_match.group(1).replace(',', ''))
+                listing.price = float(price_match.group(1).replace(',', ''))
 
         a_tag = li.find('a')
         if a_tag and 'href' in a_tag.attrs:
-            listing["url"] = "https://offerup.com" + a_tag['href']
+            listing.url = "https://offerup.com" + a_tag['href']
 
         img_tag = li.find('img')
         if img_tag and 'src' in img_tag.attrs:
-            listing["image_urls"] = [img_tag['src']]
+            listing.image_urls = [img_tag['src']]
+
+        return listing if listing.name else None
+
+    @staticmethod
+    def _parse_listing_selectolax(li):
+        listing = Listing()
+
+        title_span = li.css_first('span.MuiTypography-subtitle1')
+        if title_span:
+            listing.name = title_span.text().strip()
+
+        price_text = next((node.text() for node in li.traverse(include_text=True)
+                           if node.tag == '-text' and '$' in node.text()), None)
+        if price_text:
+            price_match = re.search(r'\$?([\d,]+(\.\d{2})?)', price_text)
+            if price_match:
+                listing.price = float(price_match.group(1).replace(',', ''))
+
+        a_tag = li.css_first('a')
+        if a_tag and 'href' in a_tag.attributes:
+            listing.url = "https://offerup.com" + a_tag.attributes['href']
+
+        img_tag = li.css_first('img')
+        if img_tag and 'src' in img_tag.attributes:
+            listing.image_urls = [img_tag.attributes['src']]
 
-        return listing if listing["name"] else None
\ No newline at end of file
+        return listing if listing.name else None
\ No newline at end of file
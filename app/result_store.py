@@ -0,0 +1,433 @@
+import asyncio
+import json
+import sqlite3
+import threading
+import time
+import zlib
+from bisect import bisect_left, bisect_right, insort
+from collections import OrderedDict
+
+from listing import Listing, dumps, encode_item, encode_items
+
+
+def encode_results(results):
+    return zlib.compress(encode_items(results))
+
+
+def decode_results(blob):
+    return json.loads(zlib.decompress(blob).decode('utf-8'))
+
+
+def item_fields(item):
+    """(price, source, is_listing) of a result item, either a Listing or a decoded item dict."""
+    if isinstance(item, Listing):
+        return item.price, item.source, True
+    if item.get('type') == 'result':
+        return (item.get('data') or {}).get('price'), item.get('source'), True
+    return None, item.get('source'), False
+
+
+class ResultIndex:
+    """The items of one search in arrival order, with a price-sorted view kept as they arrive.
+
+    Entries hold each item's encoded JSON, so queries only join bytes.
+    Cursors are "<generation>.<offset>": a search's live results are
+    generation 0 and its merged, ranked results generation 1. A live entry
+    that has been trimmed (see MemoryResultStore.trim) moves past both.
+    """
+
+    def __init__(self, generation, items=(), encoded=None):
+        self.generation = generation
+        self.entries = []
+        self.by_price = []
+        self.unpriced = []
+        self.extend(items, encoded)
+
+    def extend(self, items, encoded=None):
+        for i, item in enumerate(items):
+            price, source, is_listing = item_fields(item)
+            seq = len(self.entries)
+            self.entries.append((encoded[i] if encoded else encode_item(item), price, source, is_listing))
+            if price is None:
+                self.unpriced.append(seq)
+            else:
+                insort(self.by_price, (price, seq))
+
+    def cursor(self, offset):
+        return f"{self.generation}.{offset}"
+
+    def select(self, min_price=None, max_price=None, sources=None, sort=None, since=None, limit=None, offset=0):
+        """Returns (encoded items, next cursor, reset).
+
+        Without since, returns one page of the whole filtered, sorted view.
+        With since, returns the matching items that arrived after that
+        cursor, sorted within the page; a cursor from an earlier generation
+        starts over from the beginning and sets reset.
+        """
+        reset = False
+        if since is not None:
+            generation, _, start = since.partition('.')
+            if generation != str(self.generation):
+                reset, start = True, 0
+            start = int(start)
+            if start < 0:
+                raise ValueError(f"Negative cursor offset: {since}")
+
+        def matches(seq):
+            _, price, source, is_listing = self.entries[seq]
+            if sources and source not in sources:
+                return False
+            if is_listing and (min_price is not None or max_price is not None):
+                return price is not None and (min_price is None or price >= min_price) and \
+                    (max_price is None or price <= max_price)
+            return True
+
+        if since is not None:
+            # Page through arrival order so the cursor never skips an item
+            page = []
+            end = len(self.entries)
+            for seq in range(start, end):
+                if limit is not None and len(page) >= limit:
+                    end = seq
+                    break
+                if matches(seq):
+                    page.append(seq)
+            if sort in ('price', '-price'):
+                page.sort(key=lambda seq: (self.entries[seq][1] is None, self.entries[seq][1] or 0),
+                          reverse=sort == '-price')
+            return [self.entries[seq][0] for seq in page], self.cursor(end), reset
+
+        if sort in ('price', '-price'):
+            low = 0 if min_price is None else bisect_left(self.by_price, (min_price, -1))
+            high = len(self.by_price) if max_price is None else bisect_right(self.by_price, (max_price, len(self.entries)))
+            seqs = [seq for _, seq in self.by_price[low:high]]
+            if sort == '-price':
+                seqs.reverse()
+            # Errors and unpriced listings go after the priced ones
+            ordered = seqs + self.unpriced
+        else:
+            ordered = range(len(self.entries))
+        selected = [seq for seq in ordered if matches(seq)]
+        selected = selected[offset:offset + limit] if limit is not None else selected[offset:]
+        return [self.entries[seq][0] for seq in selected], self.cursor(len(self.entries)), reset
+
+
+def _resolve(waiter):
+    if not waiter.done():
+        waiter.set_result(None)
+
+
+class MemoryResultStore:
+    def __init__(self, ttl=600, max_entries=1000, max_bytes=128 * 1024 * 1024, purge_interval=30, max_indexes=64,
+                 stream_grace=60):
+        self.ttl = ttl
+        self.stream_grace = stream_grace
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.purge_interval = purge_interval
+        self.lock = threading.Lock()
+        self.changed = threading.Condition(self.lock)
+        self.pending = {}
+        self.indexes = {}
+        self.max_indexes = max_indexes
+        self.finished_indexes = OrderedDict()
+        # A finished search's items in arrival order, for streams still
+        # catching up; search_id -> (expires_at, items)
+        self.arrivals = OrderedDict()
+        # How many items trim() has dropped from the front of a pending entry
+        self.dropped = {}
+        self.waiters = {}
+        self.completed = OrderedDict()
+        self.size = 0
+        self.evictions = 0
+        self.expirations = 0
+        self.last_purge = time.monotonic()
+
+    def start(self, search_id):
+        with self.lock:
+            self.pending.setdefault(search_id, [])
+            self.indexes.setdefault(search_id, ResultIndex(0))
+
+    def add(self, search_id, items):
+        with self.changed:
+            self.pending.setdefault(search_id, []).extend(items)
+            self.indexes.setdefault(search_id, ResultIndex(0)).extend(items)
+            self.changed.notify_all()
+            self._wake(search_id)
+
+    def discard(self, search_id):
+        """Forget an entry started for a search that will not run."""
+        with self.changed:
+            self.pending.pop(search_id, None)
+            self.indexes.pop(search_id, None)
+            self.dropped.pop(search_id, None)
+            self.changed.notify_all()
+            self._wake(search_id)
+
+    def trim(self, search_id, max_items):
+        """Keep only the newest max_items of an entry still in progress.
+
+        For entries that never finish, like a watch's. Stream offsets keep
+        counting from the first item ever added, so a stream that had not
+        read the dropped items skips them.
+        """
+        with self.changed:
+            pending = self.pending.get(search_id)
+            if pending is None or len(pending) <= max_items:
+                return
+            dropped = self.dropped[search_id] = self.dropped.get(search_id, 0) + len(pending) - max_items
+            del pending[:len(pending) - max_items]
+            # Cursors into the old index no longer line up; a new generation resets them
+            self.indexes[search_id] = ResultIndex(1 + dropped, pending)
+
+    def finish(self, search_id, results=None):
+        if results is None:
+            with self.lock:
+                results = list(self.pending.get(search_id, []))
+        self._store(search_id, encode_results(results))
+        index = ResultIndex(1, results)
+        with self.changed:
+            arrivals = self.pending.pop(search_id, None)
+            # Offsets into a trimmed entry's arrivals no longer line up
+            if arrivals and not self.dropped.pop(search_id, 0):
+                self.arrivals[search_id] = (time.monotonic() + self.stream_grace, arrivals)
+                self.arrivals.move_to_end(search_id)
+                while len(self.arrivals) > self.max_indexes:
+                    self.arrivals.popitem(last=False)
+            self.indexes.pop(search_id, None)
+            self._cache_index(search_id, index)
+            self.changed.notify_all()
+            self._wake(search_id)
+
+    def _cache_index(self, search_id, index):
+        # Never outlives the stored results it was built from
+        self.finished_indexes[search_id] = (time.monotonic() + self.ttl, index)
+        self.finished_indexes.move_to_end(search_id)
+        while len(self.finished_indexes) > self.max_indexes:
+            self.finished_indexes.popitem(last=False)
+
+    def query(self, search_id, **options):
+        """Filter, sort and page a search's results; see ResultIndex.select for the options.
+
+        Returns (is_searching, JSON array bytes, next cursor, reset).
+        """
+        with self.lock:
+            index = self.indexes.get(search_id)
+            is_searching = index is not None
+            if index is None:
+                expires_at, index = self.finished_indexes.get(search_id, (None, None))
+                if index is not None and expires_at < time.monotonic():
+                    del self.finished_indexes[search_id]
+                    index = None
+                elif index is not None:
+                    self.finished_indexes.move_to_end(search_id)
+            if index is not None:
+                items, cursor, reset = index.select(**options)
+                return is_searching, b'[' + b','.join(items) + b']', cursor, reset
+        blob = self._load(search_id)
+        results = decode_results(blob) if blob is not None else []
+        index = ResultIndex(1, results, [dumps(item) for item in results])
+        if blob is not None:
+            with self.lock:
+                self._cache_index(search_id, index)
+        items, cursor, reset = index.select(**options)
+        return False, b'[' + b','.join(items) + b']', cursor, reset
+
+    def is_searching(self, search_id):
+        with self.lock:
+            return search_id in self.pending
+
+    def get(self, search_id):
+        with self.lock:
+            if search_id in self.pending:
+                return True, list(self.pending[search_id])
+        blob = self._load(search_id)
+        return False, decode_results(blob) if blob is not None else []
+
+    def get_encoded(self, search_id):
+        """Like get(), but the results come back as an encoded JSON array."""
+        with self.lock:
+            if search_id in self.pending:
+                results = list(self.pending[search_id])
+            else:
+                results = None
+        if results is not None:
+            return True, encode_items(results)
+        blob = self._load(search_id)
+        return False, zlib.decompress(blob) if blob is not None else b'[]'
+
+    def wait(self, search_id, offset, timeout=None):
+        """Returns (is_searching, items from offset on, offset to wait from next)."""
+        with self.changed:
+            if self._caught_up(search_id, offset):
+                self.changed.wait(timeout)
+            if search_id in self.pending:
+                start = self.dropped.get(search_id, 0)
+                items = self.pending[search_id][max(offset - start, 0):]
+                return True, items, start + len(self.pending[search_id])
+        items = self._finished_items(search_id, offset)
+        return False, items, offset + len(items)
+
+    def _caught_up(self, search_id, offset):
+        # True while a search is in progress and has nothing past offset
+        pending = self.pending.get(search_id)
+        return pending is not None and self.dropped.get(search_id, 0) + len(pending) <= offset
+
+    def _finished_items(self, search_id, offset):
+        """What a stream at offset still needs once the search has finished.
+
+        A new stream gets the merged results. One already under way counted
+        its offset in arrival order, which merging changes, so it gets only
+        the arrivals it has not seen and reads the merged results from
+        /results once the search is complete.
+        """
+        if offset:
+            with self.lock:
+                expires_at, arrivals = self.arrivals.get(search_id, (0, []))
+            return arrivals[offset:] if expires_at >= time.monotonic() else []
+        blob = self._load(search_id)
+        return decode_results(blob) if blob is not None else []
+
+    async def wait_async(self, search_id, offset, timeout=None):
+        """Like wait(), for callers on an event loop: waits without holding a thread."""
+        loop = asyncio.get_running_loop()
+        waiter = None
+        with self.lock:
+            if self._caught_up(search_id, offset):
+                waiter = loop.create_future()
+                self.waiters.setdefault(search_id, []).append((loop, waiter))
+        if waiter is not None:
+            try:
+                await asyncio.wait_for(waiter, timeout)
+            except asyncio.TimeoutError:
+                with self.lock:
+                    waiters = self.waiters.get(search_id, [])
+                    if (loop, waiter) in waiters:
+                        waiters.remove((loop, waiter))
+                    if not waiters:
+                        self.waiters.pop(search_id, None)
+        return self.wait(search_id, offset, timeout=0)
+
+    def _wake(self, search_id):
+        for loop, waiter in self.waiters.pop(search_id, ()):
+            loop.call_soon_threadsafe(_resolve, waiter)
+
+    def _store(self, search_id, blob):
+        now = time.monotonic()
+        with self.lock:
+            if search_id in self.completed:
+                self.size -= len(self.completed.pop(search_id)[1])
+            self.completed[search_id] = (now + self.ttl, blob)
+            self.size += len(blob)
+            while self.completed and (len(self.completed) > self.max_entries or self.size > self.max_bytes):
+                old_id, (_, old_blob) = self.completed.popitem(last=False)
+                self.finished_indexes.pop(old_id, None)
+                self.size -= len(old_blob)
+                self.evictions += 1
+            if now - self.last_purge >= self.purge_interval:
+                self._purge_expired(now)
+
+    def _load(self, search_id):
+        now = time.monotonic()
+        with self.lock:
+            entry = self.completed.get(search_id)
+            if entry is None:
+                return None
+            expires_at, blob = entry
+            if expires_at < now:
+                del self.completed[search_id]
+                self.size -= len(blob)
+                self.expirations += 1
+                return None
+            self.completed.move_to_end(search_id)
+            return blob
+
+    def _purge_expired(self, now):
+        expired = [search_id for search_id, (expires_at, _) in self.completed.items() if expires_at < now]
+        for search_id in expired:
+            self.size -= len(self.completed.pop(search_id)[1])
+            self.finished_indexes.pop(search_id, None)
+        self.expirations += len(expired)
+        self.last_purge = now
+
+    def close(self):
+        pass
+
+    def stats(self):
+        with self.lock:
+            return {
+                "backend": "memory",
+                "pending": len(self.pending),
+                "indexes": len(self.indexes) + len(self.finished_indexes),
+                "completed": len(self.completed),
+                "bytes": self.size,
+                "evictions": self.evictions,
+                "expirations": self.expirations,
+            }
+
+
+class SQLiteResultStore(MemoryResultStore):
+    def __init__(self, path, ttl=3600, max_entries=100000, purge_interval=60):
+        super().__init__(ttl=ttl, max_entries=max_entries, purge_interval=purge_interval)
+        self.path = path
+        self.db = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self.db.execute('PRAGMA journal_mode=WAL')
+        self.db.execute(
+            'CREATE TABLE IF NOT EXISTS results ('
+            'search_id TEXT PRIMARY KEY, expires_at REAL NOT NULL, accessed_at REAL NOT NULL, payload BLOB NOT NULL)'
+        )
+        self.db.execute('CREATE INDEX IF NOT EXISTS results_accessed_at ON results (accessed_at)')
+
+    def _store(self, search_id, blob):
+        now = time.time()
+        with self.lock:
+            self.db.execute(
+                'INSERT OR REPLACE INTO results (search_id, expires_at, accessed_at, payload) VALUES (?, ?, ?, ?)',
+                (search_id, now + self.ttl, now, blob)
+            )
+            if now - self.last_purge >= self.purge_interval:
+                self._purge_expired(now)
+
+    def _load(self, search_id):
+        now = time.time()
+        with self.lock:
+            row = self.db.execute(
+                'SELECT expires_at, payload FROM results WHERE search_id = ?', (search_id,)
+            ).fetchone()
+            if row is None:
+                return None
+            expires_at, blob = row
+            if expires_at < now:
+                self.db.execute('DELETE FROM results WHERE search_id = ?', (search_id,))
+                self.expirations += 1
+                return None
+            self.db.execute('UPDATE results SET accessed_at = ? WHERE search_id = ?', (now, search_id))
+            return blob
+
+    def _purge_expired(self, now):
+        self.expirations += self.db.execute('DELETE FROM results WHERE expires_at < ?', (now,)).rowcount
+        count = self.db.execute('SELECT COUNT(*) FROM results').fetchone()[0]
+        if count > self.max_entries:
+            self.evictions += self.db.execute(
+                'DELETE FROM results WHERE search_id IN '
+                '(SELECT search_id FROM results ORDER BY accessed_at LIMIT ?)',
+                (count - self.max_entries,)
+            ).rowcount
+        self.last_purge = now
+
+    def close(self):
+        with self.lock:
+            self.db.close()
+
+    def stats(self):
+        with self.lock:
+            completed, size = self.db.execute('SELECT COUNT(*), COALESCE(SUM(LENGTH(payload)), 0) FROM results').fetchone()
+            return {
+                "backend": "sqlite",
+                "pending": len(self.pending),
+                "indexes": len(self.indexes) + len(self.finished_indexes),
+                "completed": completed,
+                "bytes": size,
+                "evictions": self.evictions,
+                "expirations": self.expirations,
+            }
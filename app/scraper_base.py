@@ -1,8 +1,54 @@
 import asyncio
-from curl_cffi.requests import AsyncSession
+import codecs
+from curl_cffi.requests import AsyncSession, Response
 from abc import ABC, abstractmethod
+from collections import OrderedDict, deque
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from contextvars import ContextVar
+from http.cookiejar import CookieJar
+import random
 import sys
+import time
 import traceback
+from urllib.parse import urlsplit
+
+import metrics
+from listing import source_id
+
+try:
+    from selectolax.lexbor import LexborHTMLParser
+except ImportError:
+    LexborHTMLParser = None
+
+try:
+    from curl_cffi import CurlInfo
+    # curl timings are cumulative from the start of the request
+    timing_infos = {
+        'dns': CurlInfo.NAMELOOKUP_TIME,
+        'connect': CurlInfo.CONNECT_TIME,
+        'tls': CurlInfo.APPCONNECT_TIME,
+        'ttfb': CurlInfo.STARTTRANSFER_TIME,
+    }
+    # New connections opened for a request (0 when one was reused) and the
+    # HTTP version it used
+    connection_infos = {
+        'connects': CurlInfo.NUM_CONNECTS,
+        'http_version': CurlInfo.HTTP_VERSION,
+    }
+except ImportError:
+    timing_infos = {}
+    connection_infos = {}
+
+try:
+    from curl_cffi import CurlHttpVersion, CurlOpt
+except ImportError:
+    CurlHttpVersion = CurlOpt = None
+
+# Older curl_cffi releases can only read a response body whole
+streaming_supported = hasattr(Response, 'aiter_content')
+
+# CURLINFO_HTTP_VERSION values
+http_versions = {1: '1.0', 2: '1.1', 3: '2', 30: '3'}
 
 if sys.platform.startswith('win'):
     asyncio.set_event_loop_policy(asyncio.WindowsSelectorEventLoopPolicy())
@@ -20,27 +66,599 @@ common_headers = {
     'Upgrade-Insecure-Requests': '1',
 }
 
+parse_executor = None
+parse_stats = {}
+
+# Monotonic time by which the current source must be done; set per source by
+# the finder and inherited by every task the search spawns
+request_deadline = ContextVar('request_deadline', default=None)
+retry_statuses = (429, 500, 502, 503, 504)
+retry_policy = {"max_retries": 2, "backoff": 0.25, "hedge": False}
+
+def configure_retries(max_retries=2, backoff=0.25, hedge=False):
+    retry_policy.update(max_retries=max_retries, backoff=backoff, hedge=hedge)
+    return retry_policy
+
+def new_session(max_clients=10, curl_options=None, cookies=None):
+    # Older curl_cffi releases cannot report per-request curl infos or take
+    # raw curl options
+    try:
+        return AsyncSession(headers=common_headers, max_clients=max_clients, cookies=cookies,
+                            curl_options=curl_options or {},
+                            curl_infos=list(timing_infos.values()) + list(connection_infos.values()))
+    except TypeError:
+        return AsyncSession(headers=common_headers, max_clients=max_clients, cookies=cookies)
+
+def configure_parse_executor(kind=None, max_workers=None):
+    global parse_executor
+    if parse_executor:
+        parse_executor.shutdown(wait=False)
+    if kind == 'process':
+        parse_executor = ProcessPoolExecutor(max_workers=max_workers)
+        # Start the workers now, before the server threads exist
+        parse_executor.submit(int).result()
+    elif kind == 'thread':
+        parse_executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='parse')
+    else:
+        parse_executor = None
+    return parse_executor
+
+async def _aiter(chunks):
+    if hasattr(chunks, '__aiter__'):
+        async for chunk in chunks:
+            yield chunk
+    else:
+        for chunk in chunks:
+            yield chunk
+
+def record_parse(source, elapsed):
+    stats = parse_stats.setdefault(source, {"count": 0, "total": 0.0, "max": 0.0})
+    stats["count"] += 1
+    stats["total"] += elapsed
+    stats["max"] = max(stats["max"], elapsed)
+
+class HostState:
+    """Token bucket and AIMD concurrency limit for one host."""
+
+    def __init__(self, rate=None, burst=1, max_concurrency=8, min_concurrency=1, initial_concurrency=None):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = float(burst)
+        self.refilled_at = time.monotonic()
+        self.max_concurrency = max_concurrency
+        self.min_concurrency = min_concurrency
+        self.limit = float(initial_concurrency or max_concurrency)
+        self.in_flight = 0
+        self.blocked_until = 0.0
+        self.changed = None
+        self.latencies = deque(maxlen=200)
+        self.counters = {"requests": 0, "successes": 0, "rejections": 0, "timeouts": 0, "errors": 0, "waits": 0,
+                         "retries": 0, "hedges": 0}
+
+    async def __aenter__(self):
+        if self.changed is None:
+            self.changed = asyncio.Condition()
+        async with self.changed:
+            waited = False
+            while True:
+                now = time.monotonic()
+                if self.in_flight >= int(self.limit):
+                    waited = True
+                    await self.changed.wait()
+                    continue
+                delay = self.blocked_until - now
+                if delay <= 0 and self.rate:
+                    self.tokens = min(self.burst, self.tokens + (now - self.refilled_at) * self.rate)
+                    self.refilled_at = now
+                    if self.tokens < 1:
+                        delay = (1 - self.tokens) / self.rate
+                if delay <= 0:
+                    break
+                waited = True
+                try:
+                    await asyncio.wait_for(self.changed.wait(), delay)
+                except asyncio.TimeoutError:
+                    pass
+            if self.rate:
+                self.tokens -= 1
+            self.in_flight += 1
+            self.counters["requests"] += 1
+            if waited:
+                self.counters["waits"] += 1
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        async with self.changed:
+            self.in_flight -= 1
+            if exc_type is not None and exc_type is not asyncio.CancelledError:
+                message = str(exc).lower()
+                self.failed(timeout=isinstance(exc, asyncio.TimeoutError) or 'timeout' in message or 'timed out' in message)
+            self.changed.notify_all()
+
+    def hedge_delay(self):
+        if len(self.latencies) < 20:
+            return None
+        return sorted(self.latencies)[int(len(self.latencies) * 0.95)]
+
+    def succeeded(self, latency=None):
+        if latency is not None:
+            self.latencies.append(latency)
+        self.counters["successes"] += 1
+        # Additive increase: about one more slot per window of successes
+        self.limit = min(self.max_concurrency, self.limit + 1 / self.limit)
+
+    def rejected(self, retry_after=None):
+        self.counters["rejections"] += 1
+        self._back_off()
+        if retry_after:
+            self.blocked_until = max(self.blocked_until, time.monotonic() + retry_after)
+
+    def failed(self, timeout=False):
+        self.counters["timeouts" if timeout else "errors"] += 1
+        if timeout:
+            self._back_off()
+
+    def _back_off(self):
+        self.limit = max(self.min_concurrency, self.limit / 2)
+        self.tokens = min(self.tokens, 0.0)
+
+    def stats(self):
+        return {
+            "limit": round(self.limit, 2),
+            "in_flight": self.in_flight,
+            "rate": self.rate,
+            "tokens": round(self.tokens, 2) if self.rate else None,
+            "blocked_for": max(0.0, self.blocked_until - time.monotonic()),
+            "p95": self.hedge_delay(),
+            **self.counters,
+        }
+
+class HostLimiter:
+    def __init__(self, rate=None, burst=1, max_concurrency=8, min_concurrency=1, host_rates=None):
+        self.rate = rate
+        self.burst = burst
+        self.max_concurrency = max_concurrency
+        self.min_concurrency = min_concurrency
+        self.host_rates = host_rates or {}
+        self.hosts = {}
+
+    def slot(self, url):
+        host = urlsplit(url).netloc
+        state = self.hosts.get(host)
+        if state is None:
+            state = self.hosts[host] = HostState(
+                rate=self.host_rates.get(host, self.rate),
+                burst=self.burst,
+                max_concurrency=self.max_concurrency,
+                min_concurrency=self.min_concurrency
+            )
+        return state
+
+    def derive(self, **overrides):
+        """A new limiter with this one's settings but for overrides, and its own per-host state."""
+        settings = dict(rate=self.rate, burst=self.burst, max_concurrency=self.max_concurrency,
+                        min_concurrency=self.min_concurrency, host_rates=self.host_rates)
+        settings.update(overrides)
+        settings['min_concurrency'] = min(settings['min_concurrency'], settings['max_concurrency'])
+        return HostLimiter(**settings)
+
+    def stats(self):
+        return {host: state.stats() for host, state in self.hosts.items()}
+
+host_limiter = HostLimiter()
+
+def configure_host_limiter(rate=None, burst=1, max_concurrency=8, host_rates=None):
+    global host_limiter
+    host_limiter = HostLimiter(rate=rate, burst=burst, max_concurrency=max_concurrency, host_rates=host_rates)
+    return host_limiter
+
+def host_stats():
+    return host_limiter.stats()
+
+class SessionPool:
+    """One curl session, and so one connection pool, per host, shared by every scraper.
+
+    Connections are kept alive and, with http2, negotiated as HTTP/2 where
+    the server supports it, with requests multiplexed over one connection
+    rather than opening more. Resolved addresses are cached for
+    dns_cache_ttl seconds and idle connections reused for up to max_idle.
+    Every session shares one cookie jar, as a browser's tabs do, so a
+    cookie set by one of a site's hosts reaches the others its domain
+    covers (Craigslist's warm-up on <metro>.craigslist.org and its API on
+    sapi.craigslist.org).
+    """
+
+    def __init__(self, max_connections=8, http2=True, dns_cache_ttl=600, max_idle=120):
+        self.max_connections = max_connections
+        self.http2 = http2
+        self.dns_cache_ttl = dns_cache_ttl
+        self.max_idle = max_idle
+        self.sessions = {}
+        self.cookies = CookieJar()
+        self.counters = {}
+        self.last_used = {}
+
+    def curl_options(self):
+        if CurlOpt is None:
+            return {}
+        options = {
+            CurlOpt.MAXCONNECTS: self.max_connections,
+            CurlOpt.DNS_CACHE_TIMEOUT: self.dns_cache_ttl,
+            CurlOpt.MAXAGE_CONN: self.max_idle,
+            CurlOpt.TCP_KEEPALIVE: 1,
+        }
+        if self.http2:
+            options[CurlOpt.HTTP_VERSION] = CurlHttpVersion.V2TLS
+            options[CurlOpt.PIPEWAIT] = 1
+        return options
+
+    def session(self, url):
+        parts = urlsplit(url)
+        origin = f"{parts.scheme}://{parts.netloc}"
+        session = self.sessions.get(origin)
+        if session is None:
+            session = self.sessions[origin] = new_session(self.max_connections, self.curl_options(), self.cookies)
+        self.last_used[origin] = time.monotonic()
+        return session
+
+    def record(self, url, response):
+        infos = getattr(response, 'infos', None) or {}
+        host = urlsplit(url).netloc
+        counters = self.counters.get(host)
+        if counters is None:
+            counters = self.counters[host] = {"requests": 0, "reused": 0, "connections": 0, "http2": 0}
+        counters["requests"] += 1
+        connects = infos.get(connection_infos.get('connects'))
+        if connects is not None:
+            counters["connections"] += connects
+            if connects == 0:
+                counters["reused"] += 1
+        if http_versions.get(infos.get(connection_infos.get('http_version'))) == '2':
+            counters["http2"] += 1
+
+    async def warm(self, urls):
+        """Open (or refresh) a connection to each URL's host with a HEAD request."""
+        async def head(url):
+            try:
+                await self.session(url).head(url, timeout=10)
+            except Exception as e:
+                print(f"Could not warm a connection to {url}: {str(e)}")
+        await asyncio.gather(*(head(url) for url in urls))
+
+    async def keep_warm(self, known_urls, interval=60):
+        """Warm the known hosts now, then again whenever one has been idle for interval seconds.
+
+        known_urls is called each time, so hosts added later are picked up.
+        """
+        while True:
+            now = time.monotonic()
+            origins = {}
+            for url in known_urls():
+                parts = urlsplit(url)
+                origins[f"{parts.scheme}://{parts.netloc}"] = f"{parts.scheme}://{parts.netloc}/"
+            await self.warm([url for origin, url in origins.items()
+                             if now - self.last_used.get(origin, -interval) >= interval])
+            await asyncio.sleep(interval / 2)
+
+    async def close(self):
+        sessions, self.sessions = list(self.sessions.values()), {}
+        for session in sessions:
+            try:
+                await session.close()
+            except Exception as e:
+                print(f"Error closing session: {str(e)}")
+
+    def stats(self):
+        return {
+            host: dict(counters, reuse_rate=counters["reused"] / counters["requests"] if counters["requests"] else 0.0)
+            for host, counters in self.counters.items()
+        }
+
+session_pool = SessionPool()
+
+def configure_session_pool(max_connections=8, http2=True, dns_cache_ttl=600, max_idle=120):
+    global session_pool
+    session_pool = SessionPool(max_connections=max_connections, http2=http2, dns_cache_ttl=dns_cache_ttl,
+                               max_idle=max_idle)
+    return session_pool
+
+def session_stats():
+    return session_pool.stats()
+
+async def keep_sessions_warm(known_urls, interval=60):
+    await session_pool.keep_warm(known_urls, interval)
+
+async def close_sessions():
+    await session_pool.close()
+
+def retry_after(response):
+    value = response.headers.get('Retry-After') if response.headers else None
+    try:
+        return float(value) if value else None
+    except ValueError:
+        return None
+
 class ScraperBase(ABC):
-    def __init__(self):
-        self.session = AsyncSession(headers=common_headers)
+    offload_parse = True
+    page_concurrency = 4
+    max_validated = 256
+    # html_stream.ListingStream subclass for the 'stream' parser backend
+    listing_stream = None
+
+    def __init__(self, parser_backend='bs4', session=None, host_limiter=None):
+        self.source = source_id(self.__class__.__name__)
+        # Requests go through the shared session pool unless a session is given
+        self.session = session
+        self.host_limiter = host_limiter
+        self.validated = OrderedDict()
+        if parser_backend == 'selectolax' and LexborHTMLParser is None:
+            print(f"selectolax is not installed, {self.__class__.__name__} falls back to bs4")
+            parser_backend = 'bs4'
+        if parser_backend == 'stream' and self.listing_stream is None:
+            print(f"{self.__class__.__name__} has no streaming extractor, falls back to bs4")
+            parser_backend = 'bs4'
+        self.parser_backend = parser_backend
     
     @abstractmethod
-    async def search(self, query):
+    async def search(self, query, max_results=None, max_pages=None, on_page=None):
+        pass
+
+    async def prepare_batch(self, queries):
+        """Do once, before a batch of searches, the setup each search would otherwise repeat."""
         pass
 
+    async def fetch_page(self, query, page, on_listings=None):
+        """Return (listings, page_count) for one results page, counting from 1.
+
+        With the 'stream' parser backend, listings are also handed to
+        on_listings as they are parsed; reading stops if it returns True.
+        """
+        raise NotImplementedError
+
+    async def search_pages(self, query, max_results=None, max_pages=None, on_page=None):
+        # With no limits only the first page is fetched; max_results alone
+        # fetches as many pages as it takes
+        if max_pages is None:
+            max_pages = 1 if max_results is None else sys.maxsize
+        listings = []
+
+        def accept(page_listings):
+            if max_results is not None:
+                page_listings = page_listings[:max_results - len(listings)]
+            if page_listings:
+                listings.extend(page_listings)
+                if on_page:
+                    on_page(page_listings)
+            return max_results is not None and len(listings) >= max_results
+
+        if self.parser_backend == 'stream':
+            # The first page's listings go out as they are parsed
+            enough = False
+
+            def on_listings(streamed):
+                nonlocal enough
+                enough = accept(streamed)
+                return enough
+
+            first, page_count = await self.fetch_page(query, 1, on_listings)
+        else:
+            first, page_count = await self.fetch_page(query, 1)
+            enough = accept(first)
+        if enough or not first:
+            return listings
+
+        last_page = min(page_count, max_pages)
+        if max_results is not None:
+            last_page = min(last_page, -(-max_results // len(first)))
+        if last_page < 2:
+            return listings
+
+        slots = asyncio.Semaphore(self.page_concurrency)
+
+        async def fetch(page):
+            async with slots:
+                try:
+                    return (await self.fetch_page(query, page))[0]
+                except Exception as e:
+                    print(f"Error fetching page {page} in {self.__class__.__name__}: {str(e)}")
+                    return []
+
+        tasks = [asyncio.ensure_future(fetch(page)) for page in range(2, last_page + 1)]
+        try:
+            for task in asyncio.as_completed(tasks):
+                if accept(await task):
+                    break
+        finally:
+            for task in tasks:
+                task.cancel()
+        return listings
+
     async def get(self, url, **kwargs):
+        limiter = self.host_limiter or host_limiter
+        deadline = request_deadline.get()
+        attempt = 0
+        while True:
+            error = None
+            try:
+                response = await self._hedged_get(limiter, url, **kwargs)
+            except Exception as e:
+                error, response = e, None
+            if response is not None and response.status_code not in retry_statuses:
+                return response
+            if response is not None and kwargs.get('stream'):
+                await response.aclose()
+
+            # Full jitter, and never sleep past the source's deadline
+            delay = random.uniform(0, retry_policy["backoff"] * 2 ** attempt)
+            if attempt >= retry_policy["max_retries"] or (deadline and time.monotonic() + delay >= deadline):
+                if error:
+                    print(f"Error in GET request to {url}: {str(error)}")
+                return response
+            attempt += 1
+            limiter.slot(url).counters["retries"] += 1
+            await asyncio.sleep(delay)
+
+    async def _hedged_get(self, limiter, url, **kwargs):
+        host = limiter.slot(url)
+        # A streamed body cannot be raced, the loser would be left open
+        delay = host.hedge_delay() if retry_policy["hedge"] and not kwargs.get('stream') else None
+        first = asyncio.ensure_future(self._send(limiter, url, **kwargs))
+        if delay is None:
+            return await first
+
+        done, _ = await asyncio.wait({first}, timeout=delay)
+        if done:
+            return first.result()
+        # Slower than this host's p95: race a duplicate against the original
+        host.counters["hedges"] += 1
+        pending = {first, asyncio.ensure_future(self._send(limiter, url, **kwargs))}
         try:
-            return await self.session.get(url, **kwargs)
-        except Exception as e:
-            print(f"Error in GET request to {url}: {str(e)}")
-            return None
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    if task.exception() is None:
+                        return task.result()
+            return task.result()
+        finally:
+            for task in pending:
+                task.cancel()
 
-    async def close(self):
-        await self.session.close()
+    async def _send(self, limiter, url, **kwargs):
+        async with limiter.slot(url) as host:
+            start = time.monotonic()
+            response = await (self.session or session_pool.session(url)).get(url, **kwargs)
+            elapsed = time.monotonic() - start
+            self._record_timings(url, response, elapsed)
+            session_pool.record(url, response)
+            if response.status_code in (403, 429):
+                host.rejected(retry_after(response))
+            elif response.status_code < 500:
+                host.succeeded(elapsed)
+            return response
+
+    def _record_timings(self, url, response, elapsed):
+        source = self.__class__.__name__
+        host = urlsplit(url).netloc
+        metrics.http_request.observe(elapsed, source, host, 'total')
+        infos = getattr(response, 'infos', None) or {}
+        for stage, info in timing_infos.items():
+            value = infos.get(info)
+            # Zero means the stage did not happen, e.g. a reused connection
+            if value:
+                metrics.http_request.observe(value, source, host, stage)
+
+    async def conditional_get(self, url, params=None):
+        """GET, revalidating against an earlier response to the same request.
+
+        Returns (response, cached); cached is the value remember()ed for the
+        request when the server answered 304 Not Modified, otherwise None.
+        """
+        key = (url, tuple(sorted(params.items())) if params else ())
+        entry = self.validated.get(key)
+        headers = {}
+        if entry:
+            etag, modified, _ = entry
+            if etag:
+                headers['If-None-Match'] = etag
+            if modified:
+                headers['If-Modified-Since'] = modified
+        response = await self.get(url, params=params, headers=headers)
+        if entry and response is not None and response.status_code == 304:
+            self.validated.move_to_end(key)
+            return response, entry[2]
+        return response, None
+
+    def remember(self, response, url, params, value):
+        etag = response.headers.get('ETag')
+        modified = response.headers.get('Last-Modified')
+        if not (etag or modified):
+            return
+        key = (url, tuple(sorted(params.items())) if params else ())
+        self.validated[key] = (etag, modified, value)
+        self.validated.move_to_end(key)
+        while len(self.validated) > self.max_validated:
+            self.validated.popitem(last=False)
+
+    async def stream_listings(self, url, params=None, extractor=None):
+        """Yield a page's listings one at a time as its body downloads.
+
+        The body is fed to extractor (a new listing_stream by default) in
+        chunks, and reading stops once the results container has closed or
+        the caller stops iterating. Yields nothing without a 200 response.
+        """
+        extractor = extractor or self.listing_stream()
+        if streaming_supported:
+            response = await self.get(url, params=params, stream=True)
+        else:
+            response = await self.get(url, params=params)
+        if response is None:
+            # Retries ran out or the deadline passed
+            return
+        if response.status_code != 200:
+            print(f"Error: Status code {response.status_code}")
+            if streaming_supported:
+                await response.aclose()
+            return
+
+        chunks = response.aiter_content() if streaming_supported else [response.content]
+        decoder = codecs.getincrementaldecoder('utf-8')('replace')
+        parse_time = 0.0
+        try:
+            async for chunk in _aiter(chunks):
+                start = time.perf_counter()
+                extractor.feed(decoder.decode(chunk))
+                ready = extractor.take()
+                parse_time += time.perf_counter() - start
+                for listing in ready:
+                    listing.set_source(self.source)
+                    yield listing
+                if extractor.done:
+                    break
+            else:
+                extractor.feed(decoder.decode(b'', final=True))
+                extractor.close()
+                for listing in extractor.take():
+                    listing.set_source(self.source)
+                    yield listing
+        finally:
+            record_parse(self.__class__.__name__, parse_time)
+            metrics.parse_duration.observe(parse_time, self.__class__.__name__)
+            if streaming_supported:
+                await response.aclose()
+
+    async def fetch_streamed(self, url, params=None, on_listings=None):
+        """Collect stream_listings() for fetch_page; returns (listings, extractor)."""
+        extractor = self.listing_stream()
+        listings = []
+        stream = self.stream_listings(url, params, extractor)
+        try:
+            async for listing in stream:
+                listings.append(listing)
+                if on_listings and on_listings([listing]):
+                    break
+        finally:
+            await stream.aclose()
+        return listings, extractor
+
+    def extractor(self):
+        return getattr(self, f'_extract_listings_{self.parser_backend}', None) or self._extract_listings
+
+    async def parse(self, extract, payload):
+        start = time.perf_counter()
+        if self.offload_parse and parse_executor is not None:
+            result = await asyncio.get_running_loop().run_in_executor(parse_executor, extract, payload)
+        else:
+            result = extract(payload)
+        for listing in result:
+            listing.set_source(self.source)
+        elapsed = time.perf_counter() - start
+        record_parse(self.__class__.__name__, elapsed)
+        metrics.parse_duration.observe(elapsed, self.__class__.__name__)
+        return result
 
-    async def safe_search(self, query):
+    async def safe_search(self, query, max_results=None, max_pages=None, on_page=None):
         try:
-            return await self.search(query)
+            return await self.search(query, max_results=max_results, max_pages=max_pages, on_page=on_page)
         except Exception as e:
             print(f"Error in {self.__class__.__name__}: {str(e)}")
             traceback.print_exc()
@@ -0,0 +1,98 @@
+import asyncio
+import time
+from collections import OrderedDict
+
+from listing import encode_items
+
+
+def normalize_query(query):
+    return ' '.join(query.lower().split())
+
+
+class SearchCache:
+    def __init__(self, default_ttl=300, ttls=None, max_entries=1000, max_bytes=64 * 1024 * 1024):
+        self.default_ttl = default_ttl
+        self.ttls = ttls or {}
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict()
+        self.in_flight = {}
+        self.size = 0
+        self.counters = {}
+
+    def _count(self, source, name):
+        counters = self.counters.setdefault(source, {"hits": 0, "misses": 0, "coalesced": 0, "evictions": 0})
+        counters[name] += 1
+
+    def ttl_for(self, source):
+        return self.ttls.get(source, self.default_ttl)
+
+    def get(self, source, query):
+        key = (normalize_query(query), source)
+        entry = self.entries.get(key)
+        if entry is None:
+            return None
+        expires_at, _, listings = entry
+        if expires_at < time.monotonic():
+            self._remove(key)
+            return None
+        self.entries.move_to_end(key)
+        return listings
+
+    def put(self, source, query, listings):
+        ttl = self.ttl_for(source)
+        if ttl <= 0:
+            return
+        key = (normalize_query(query), source)
+        if key in self.entries:
+            self._remove(key)
+        cost = len(encode_items(listings))
+        if cost > self.max_bytes:
+            return
+        self.entries[key] = (time.monotonic() + ttl, cost, listings)
+        self.size += cost
+        while len(self.entries) > self.max_entries or self.size > self.max_bytes:
+            old_key, _ = next(iter(self.entries.items()))
+            self._remove(old_key)
+            self._count(old_key[1], "evictions")
+
+    def _remove(self, key):
+        _, cost, _ = self.entries.pop(key)
+        self.size -= cost
+
+    async def fetch(self, scraper, query, on_page=None, fresh=False, **options):
+        """A source's listings for query, from the cache unless fresh.
+
+        A fresh fetch still joins a request already in flight and still
+        stores what it scrapes.
+        """
+        source = scraper.__class__.__name__
+        listings = None if fresh else self.get(source, query)
+        if listings is not None:
+            self._count(source, "hits")
+            return listings
+
+        key = (normalize_query(query), source)
+        task = self.in_flight.get(key)
+        if task is not None:
+            self._count(source, "coalesced")
+            return await asyncio.shield(task)
+
+        self._count(source, "misses")
+        task = asyncio.ensure_future(scraper.safe_search(query, on_page=on_page, **options))
+        self.in_flight[key] = task
+        try:
+            listings = await asyncio.shield(task)
+        finally:
+            self.in_flight.pop(key, None)
+        if listings:
+            self.put(source, query, listings)
+        return listings
+
+    def stats(self):
+        return {
+            "entries": len(self.entries),
+            "bytes": self.size,
+            "in_flight": len(self.in_flight),
+            "sources": {source: dict(counters) for source, counters in self.counters.items()},
+        }
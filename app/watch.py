@@ -0,0 +1,177 @@
+import asyncio
+import hashlib
+import heapq
+import logging
+import math
+import random
+import threading
+import time
+import uuid
+
+from listing import Listing
+
+
+class SeenSet:
+    """Bloom filter over listing keys; a false positive only hides a new listing."""
+
+    def __init__(self, capacity=5000, error_rate=0.001):
+        self.size = max(64, int(-capacity * math.log(error_rate) / math.log(2) ** 2))
+        self.hashes = max(1, round(self.size / capacity * math.log(2)))
+        self.bits = bytearray((self.size + 7) // 8)
+        self.count = 0
+
+    def _positions(self, key):
+        digest = hashlib.blake2b(key.encode('utf-8'), digest_size=16).digest()
+        a = int.from_bytes(digest[:8], 'little')
+        b = int.from_bytes(digest[8:], 'little') | 1
+        return [(a + i * b) % self.size for i in range(self.hashes)]
+
+    def add(self, key):
+        """Add key; returns True if it was not seen before."""
+        new = False
+        for position in self._positions(key):
+            byte, bit = divmod(position, 8)
+            if not self.bits[byte] & (1 << bit):
+                self.bits[byte] |= 1 << bit
+                new = True
+        if new:
+            self.count += 1
+        return new
+
+
+def listing_key(listing):
+    return listing.url or f"{listing.source}:{listing.name}:{listing.price}"
+
+
+class Watch:
+    def __init__(self, watch_id, query, interval, callback=None, emit_initial=False, capacity=5000):
+        self.id = watch_id
+        self.query = query
+        self.interval = interval
+        self.callback = callback
+        self.emit_initial = emit_initial
+        self.seen = SeenSet(capacity)
+        self.polls = 0
+        self.new_listings = 0
+        self.last_poll = None
+        self.active = True
+
+    def diff(self, listings):
+        new = [listing for listing in listings if self.seen.add(listing_key(listing))]
+        # The first poll only learns what is already listed
+        if self.polls == 0 and not self.emit_initial:
+            return []
+        return new
+
+
+class WatchScheduler:
+    def __init__(self, finder, default_interval=300, jitter=0.2, max_concurrent=4, min_interval=30, max_watches=100):
+        self.finder = finder
+        self.default_interval = default_interval
+        self.jitter = jitter
+        self.max_concurrent = max_concurrent
+        self.min_interval = min_interval
+        self.max_watches = max_watches
+        # Watch ids, kept in step with add()/remove() on the caller's thread
+        # so the max_watches check does not wait for the finder loop
+        self.ids = set()
+        self.lock = threading.Lock()
+        self.watches = {}
+        self.schedule = []
+        self.wakeup = None
+        self.slots = None
+        self.polls = 0
+        self.errors = 0
+
+    def add(self, query, interval=None, callback=None, emit_initial=False, watch_id=None):
+        """Register a watch from any thread; callback(watch, new_listings) runs on the finder loop.
+
+        Returns the watch id, or None when max_watches are already active.
+        Raises ValueError unless interval is None or a positive number of
+        seconds; intervals below min_interval are raised to it.
+        """
+        if interval is None:
+            interval = self.default_interval
+        elif isinstance(interval, bool) or not isinstance(interval, (int, float)) or not 0 < interval < math.inf:
+            raise ValueError("interval must be a positive number of seconds")
+        # Every poll is a live search on every source
+        interval = max(interval, self.min_interval)
+        with self.lock:
+            if len(self.ids) >= self.max_watches:
+                return None
+            watch = Watch(watch_id or str(uuid.uuid4()), query, interval, callback, emit_initial)
+            self.ids.add(watch.id)
+        self.finder.loop.call_soon_threadsafe(self._add, watch)
+        return watch.id
+
+    def remove(self, watch_id):
+        with self.lock:
+            self.ids.discard(watch_id)
+        self.finder.loop.call_soon_threadsafe(self._remove, watch_id)
+
+    def _add(self, watch):
+        self.watches[watch.id] = watch
+        # Spread first polls out a little so a burst of new watches does not
+        # turn into a burst of searches
+        self._schedule(watch, random.uniform(0, min(watch.interval, 5)))
+
+    def _remove(self, watch_id):
+        watch = self.watches.pop(watch_id, None)
+        if watch:
+            watch.active = False
+
+    def _schedule(self, watch, delay):
+        heapq.heappush(self.schedule, (time.monotonic() + delay, watch.id))
+        if self.wakeup:
+            self.wakeup.set()
+
+    async def run(self):
+        self.wakeup = asyncio.Event()
+        self.slots = asyncio.Semaphore(self.max_concurrent)
+        while True:
+            now = time.monotonic()
+            while self.schedule and self.schedule[0][0] <= now:
+                _, watch_id = heapq.heappop(self.schedule)
+                watch = self.watches.get(watch_id)
+                if watch:
+                    await self.slots.acquire()
+                    asyncio.ensure_future(self._poll(watch))
+            self.wakeup.clear()
+            timeout = self.schedule[0][0] - now if self.schedule else None
+            try:
+                await asyncio.wait_for(self.wakeup.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+
+    async def _poll(self, watch):
+        try:
+            listings = []
+            # Past the search cache, or a poll could return what the last one saw
+            await self.finder.run_sources(
+                watch.query, lambda items: listings.extend(item for item in items if isinstance(item, Listing)),
+                fresh=True
+            )
+            new = watch.diff(listings)
+            watch.polls += 1
+            watch.last_poll = time.time()
+            self.polls += 1
+            if new and watch.active:
+                watch.new_listings += len(new)
+                if watch.callback:
+                    watch.callback(watch, new)
+        except Exception as e:
+            self.errors += 1
+            logging.error(f"Error polling watch {watch.id}: {str(e)}")
+        finally:
+            self.slots.release()
+            if watch.active:
+                self._schedule(watch, watch.interval * random.uniform(1 - self.jitter, 1 + self.jitter))
+
+    def stats(self):
+        return {
+            "watches": len(self.watches),
+            "scheduled": len(self.schedule),
+            "polls": self.polls,
+            "errors": self.errors,
+            "new_listings": sum(watch.new_listings for watch in self.watches.values()),
+        }
@@ -0,0 +1,42 @@
+"""Search worker: runs searches from the shared broker queue (see broker.py).
+
+    BROKER_URL=zmq://broker-host:5560 WORKER_PROCESSES=4 python worker.py
+
+Each process configures itself from the environment like main.py does.
+"""
+import logging
+import multiprocessing
+import os
+import signal
+import threading
+
+
+def run_worker():
+    os.environ['SERVER_MODE'] = 'worker'
+    from main import finder
+
+    stopped = threading.Event()
+    signal.signal(signal.SIGTERM, lambda *_: stopped.set())
+    signal.signal(signal.SIGINT, lambda *_: stopped.set())
+    finder.start()
+    logging.info(f"Worker {os.getpid()} running up to {finder.max_concurrent_searches} searches")
+    stopped.wait()
+    finder.stop()
+
+
+if __name__ == "__main__":
+    if not os.environ.get('BROKER_URL'):
+        raise SystemExit("worker.py needs BROKER_URL")
+    processes = [
+        multiprocessing.get_context('spawn').Process(target=run_worker, name=f'worker-{i}')
+        for i in range(int(os.environ.get('WORKER_PROCESSES', 1)))
+    ]
+    for process in processes:
+        process.start()
+    try:
+        for process in processes:
+            process.join()
+    except KeyboardInterrupt:
+        for process in processes:
+            process.terminate()
+            process.join()
@@ -0,0 +1,127 @@
+import asyncio
+import json
+import logging
+import zmq
+import zmq.asyncio
+from listing import encode_item
+
+
+class ZmqSearchServer:
+    def __init__(self, finder, address="tcp://*:5555"):
+        self.finder = finder
+        self.address = address
+        self.context = zmq.asyncio.Context.instance()
+        self.socket = None
+        self.client_searches = {}
+        self.client_watches = {}
+
+    async def serve(self):
+        self.socket = self.context.socket(zmq.ROUTER)
+        self.socket.bind(self.address)
+        logging.info(f"ZMQ search server listening on {self.address}")
+        try:
+            while True:
+                frames = await self.socket.recv_multipart()
+                identity = frames[0]
+                # One bad message must not stop the server for every client
+                if len(frames) != 2:
+                    await self.send(identity, {"type": "error", "source": "server",
+                                               "message": "Expected a single JSON frame"})
+                    continue
+                try:
+                    command = json.loads(frames[1])
+                except ValueError:
+                    await self.send(identity, {"type": "error", "source": "server", "message": "Invalid JSON"})
+                    continue
+                if not isinstance(command, dict):
+                    await self.send(identity, {"type": "error", "source": "server",
+                                               "message": "Expected a JSON object"})
+                    continue
+                try:
+                    self.handle(identity, command)
+                except Exception as e:
+                    logging.error(f"Error handling {command.get('type')} command: {str(e)}")
+                    await self.send(identity, {"type": "error", "source": "server", "message": f"Error: {str(e)}"})
+        finally:
+            for task in self.client_searches.values():
+                task.cancel()
+            for identity in list(self.client_watches):
+                self.unwatch(identity)
+            self.socket.close(linger=0)
+
+    def handle(self, identity, command):
+        command_type = command.get('type')
+        if command_type == 'search' and command.get('query'):
+            self.cancel(identity)
+            task = asyncio.ensure_future(self.run_search(identity, command['query']))
+            self.client_searches[identity] = task
+        elif command_type == 'watch' and command.get('query'):
+            try:
+                watch_id = self.finder.watches.add(command['query'], command.get('interval'),
+                                                   self.watch_callback(identity))
+            except ValueError as e:
+                watch_id, error = None, str(e)
+            else:
+                error = f"At most {self.finder.watches.max_watches} watches can be active"
+            if watch_id is None:
+                asyncio.ensure_future(self.send(identity, {"type": "error", "source": "server", "message": error}))
+                return
+            self.client_watches.setdefault(identity, set()).add(watch_id)
+            asyncio.ensure_future(self.send(identity, {
+                "type": "watch_started",
+                "watch_id": watch_id,
+                "query": command['query']
+            }))
+        elif command_type == 'unwatch' and command.get('watch_id'):
+            self.unwatch(identity, command['watch_id'])
+        elif command_type == 'cancel':
+            self.cancel(identity)
+        elif command_type == 'exit':
+            self.cancel(identity)
+            self.unwatch(identity)
+        else:
+            asyncio.ensure_future(self.send(identity, {
+                "type": "error",
+                "source": "server",
+                "message": f"Unknown command: {command_type}"
+            }))
+
+    def cancel(self, identity):
+        task = self.client_searches.pop(identity, None)
+        if task:
+            task.cancel()
+
+    def unwatch(self, identity, watch_id=None):
+        """Stop one of a client's watches, or all of them."""
+        watches = self.client_watches.get(identity, set())
+        for watch in [watch_id] if watch_id else list(watches):
+            if watch in watches:
+                watches.discard(watch)
+                self.finder.watches.remove(watch)
+        if not watches:
+            self.client_watches.pop(identity, None)
+
+    def watch_callback(self, identity):
+        def callback(watch, listings):
+            asyncio.ensure_future(self.send(identity, {
+                "type": "watch_results",
+                "watch_id": watch.id,
+                "query": watch.query,
+                "listings": listings
+            }))
+        return callback
+
+    async def run_search(self, identity, query):
+        try:
+            async for item in self.finder.stream(query):
+                await self.send(identity, item)
+            await self.send(identity, {"type": "search_complete", "query": query})
+        except asyncio.CancelledError:
+            await self.send(identity, {"type": "search_cancelled", "query": query})
+            raise
+        finally:
+            if self.client_searches.get(identity) is asyncio.current_task():
+                del self.client_searches[identity]
+
+    async def send(self, identity, message):
+        await self.socket.send_multipart([identity, encode_item(message)])
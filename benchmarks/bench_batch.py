@@ -0,0 +1,105 @@
+import argparse
+import json
+import multiprocessing
+import os
+import sys
+import time
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(BENCH_DIR, '..', 'app'))
+sys.path.insert(0, BENCH_DIR)
+
+from bench_search import run_search, serve_flask, wait_for_port
+from stub_server import point_scrapers, serve
+
+
+def run_batch(base, queries):
+    """Submit queries as one batch and read the batch's SSE stream to the end."""
+    start = time.perf_counter()
+    request = urllib.request.Request(f"{base}/batch", data=json.dumps({"queries": queries}).encode(),
+                                     headers={'Content-Type': 'application/json'}, method='POST')
+    with urllib.request.urlopen(request) as response:
+        batch = json.load(response)
+
+    completions = []
+    with urllib.request.urlopen(f"{base}{batch['stream']}") as response:
+        for line in response:
+            line = line.decode('utf-8').strip()
+            if line.startswith('event: search_complete'):
+                break
+            if line.startswith('data: '):
+                item = json.loads(line[6:])
+                completions.append((time.perf_counter() - start, item['count']))
+    return time.perf_counter() - start, completions
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Wall time of a batch of queries, run one by one and as a /batch")
+    parser.add_argument('--queries', type=int, default=50, help="queries in the batch")
+    parser.add_argument('--clients', type=int, default=4,
+                        help="concurrent clients for the query-at-a-time run")
+    parser.add_argument('--latency', type=float, default=0.05, help="stub latency per request, seconds")
+    parser.add_argument('--host-rate', type=float, default=None, help="HOST_RATE, requests/sec per host")
+    parser.add_argument('--stub-port', type=int, default=8765)
+    parser.add_argument('--app-port', type=int, default=8766)
+    parser.add_argument('--json', action='store_true', help="print the report as JSON")
+    args = parser.parse_args()
+
+    stub = multiprocessing.Process(target=serve, kwargs={'port': args.stub_port, 'latency': args.latency}, daemon=True)
+    stub.start()
+    wait_for_port(args.stub_port)
+
+    os.environ['ZMQ_BIND'] = ''
+    # Only the stub server is reachable; warming would go to the real hosts
+    os.environ['WARM_INTERVAL'] = '0'
+    os.environ['MAX_QUEUE_SIZE'] = str(args.queries * 2)
+    if args.host_rate:
+        os.environ['HOST_RATE'] = str(args.host_rate)
+    for name in ('CACHE_TTL', 'CRAIGSLIST_CACHE_TTL', 'EBAY_CACHE_TTL', 'OFFERUP_CACHE_TTL'):
+        os.environ[name] = '0'
+    import main as app_main
+
+    point_scrapers(app_main.finder.scrapers, f"http://127.0.0.1:{args.stub_port}")
+    shutdown = serve_flask(app_main, args.app_port)
+    base = f"http://127.0.0.1:{args.app_port}"
+    run_search(base, 'warmup')
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=args.clients) as clients:
+        singles = list(clients.map(lambda i: run_search(base, f"single{i}"), range(args.queries)))
+    singles_elapsed = time.perf_counter() - start
+
+    # New queries, as the single searches have cached theirs
+    batch_elapsed, completions = run_batch(base, [f"batch{i}" for i in range(args.queries)])
+
+    shutdown()
+    app_main.finder.stop()
+    stub.terminate()
+
+    single_latency = sum(latency for latency, _, _, _ in singles) / len(singles)
+    report = {
+        "queries": args.queries,
+        "single_search_latency": single_latency,
+        "one_at_a_time": singles_elapsed,
+        "one_at_a_time_clients": args.clients,
+        "batch": batch_elapsed,
+        "batch_first_query": completions[0][0] if completions else None,
+        "batch_results_per_query": sum(count for _, count in completions) / max(len(completions), 1),
+    }
+    if args.json:
+        print(json.dumps(report, indent=2))
+    else:
+        print(f"{args.queries} queries, stub latency {args.latency * 1000:.0f}ms, "
+              f"host rate {args.host_rate or 'unlimited'}")
+        print(f"  single search     {single_latency * 1000:.0f}ms  "
+              f"({args.queries}x that is {single_latency * args.queries:.1f}s)")
+        print(f"  one at a time     {singles_elapsed:.2f}s with {args.clients} clients")
+        print(f"  /batch            {batch_elapsed:.2f}s, first query done after "
+              f"{report['batch_first_query'] * 1000:.0f}ms")
+        print(f"  results/query     {report['batch_results_per_query']:.0f} merged listings per batched query")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,123 @@
+import argparse
+import codecs
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'app'))
+
+from ebay_scraper import EbayScraper
+from offerup_scraper import OfferUpScraper
+
+FIXTURES = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'fixtures')
+
+CASES = [
+    (EbayScraper, 'ebay_bike.html'),
+    (OfferUpScraper, 'offerup_bike.html'),
+]
+
+CHUNK_SIZE = 16384
+# The network decides where chunks end; small ones split text, tags and characters
+CHECK_CHUNK_SIZES = tuple(range(1, 64)) + (127, 512, 1500, 4096, CHUNK_SIZE)
+
+
+def extract_streamed(scraper, chunk_size=CHUNK_SIZE):
+    def extract(html):
+        # Fed in network sized chunks, stopping where stream_listings would
+        stream = scraper.listing_stream()
+        decoder = codecs.getincrementaldecoder('utf-8')('replace')
+        listings = []
+        for start in range(0, len(html), chunk_size):
+            stream.feed(decoder.decode(html[start:start + chunk_size]))
+            listings.extend(stream.take())
+            if stream.done:
+                return listings
+        stream.feed(decoder.decode(b'', final=True))
+        stream.close()
+        return listings + stream.take()
+    return extract
+
+
+BACKENDS = {
+    'bs4': lambda scraper: scraper._extract_listings,
+    'selectolax': lambda scraper: scraper._extract_listings_selectolax,
+    'stream': extract_streamed,
+}
+
+
+def load(name):
+    with open(os.path.join(FIXTURES, name), 'rb') as f:
+        return f.read()
+
+
+def compare(scraper, fixture, backend, actual, expected):
+    if actual == expected:
+        return 0
+    print(f"FAIL {scraper.__name__} {fixture}: {backend} returned {len(actual)} listings, bs4 {len(expected)}")
+    for a, b in zip(actual, expected):
+        if a != b:
+            print(f"  first difference:\n    {backend}: {a}\n    bs4: {b}")
+            break
+    return 1
+
+
+def check_equivalence():
+    failures = 0
+    for scraper, fixture in CASES:
+        html = load(fixture)
+        expected = scraper._extract_listings(html)
+        if not expected:
+            print(f"FAIL {scraper.__name__} {fixture}: bs4 backend found no listings")
+            failures += 1
+            continue
+        for backend, extractor in BACKENDS.items():
+            if backend == 'bs4':
+                continue
+            if backend == 'stream':
+                failed = sum(compare(scraper, fixture, f"stream/{size}", extract_streamed(scraper, size)(html), expected)
+                             for size in CHECK_CHUNK_SIZES)
+                if not failed:
+                    print(f"ok   {scraper.__name__} {fixture}: stream gives {len(expected)} identical listings "
+                          f"in chunks of {CHECK_CHUNK_SIZES[0]} to {CHECK_CHUNK_SIZES[-1]} bytes")
+                failures += failed
+                continue
+            if not compare(scraper, fixture, backend, extractor(scraper)(html), expected):
+                print(f"ok   {scraper.__name__} {fixture}: {backend} gives {len(expected)} identical listings")
+    return failures
+
+
+def bench(extract, html, seconds):
+    pages = 0
+    start = time.perf_counter()
+    while True:
+        extract(html)
+        pages += 1
+        elapsed = time.perf_counter() - start
+        if elapsed >= seconds:
+            return pages / elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Check and benchmark the HTML extraction backends on saved pages")
+    parser.add_argument('--seconds', type=float, default=2.0, help="time spent on each scraper/backend pair")
+    parser.add_argument('--check-only', action='store_true', help="only verify that the backends emit identical listings")
+    args = parser.parse_args()
+
+    if check_equivalence():
+        sys.exit(1)
+    if args.check_only:
+        return
+
+    print()
+    print(f"{'scraper':<16}{'backend':<12}{'pages/sec':>12}")
+    for scraper, fixture in CASES:
+        html = load(fixture)
+        baseline = None
+        for backend, extractor in BACKENDS.items():
+            rate = bench(extractor(scraper), html, args.seconds)
+            baseline = baseline or rate
+            print(f"{scraper.__name__:<16}{backend:<12}{rate:>12.1f}  ({rate / baseline:.1f}x)")
+
+
+if __name__ == "__main__":
+    main()
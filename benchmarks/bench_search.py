@@ -0,0 +1,199 @@
+import argparse
+import json
+import logging
+import multiprocessing
+import os
+import resource
+import socket
+import statistics
+import sys
+import threading
+import time
+import urllib.error
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(BENCH_DIR, '..', 'app'))
+sys.path.insert(0, BENCH_DIR)
+
+from stub_server import point_scrapers, serve
+
+
+def wait_for_port(port, timeout=10.0):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            socket.create_connection(('127.0.0.1', port), timeout=0.5).close()
+            return
+        except OSError:
+            time.sleep(0.05)
+    raise RuntimeError(f"Nothing listening on port {port}")
+
+
+def percentile(values, fraction):
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * fraction))] if ordered else 0.0
+
+
+def run_search(base, query):
+    """Queue a search through Flask and read its SSE stream to the end."""
+    start = time.perf_counter()
+    while True:
+        try:
+            with urllib.request.urlopen(f"{base}/search/{query}") as response:
+                search_id = json.load(response)['search_id']
+            break
+        except urllib.error.HTTPError as e:
+            if e.code != 429:
+                raise
+            time.sleep(0.05)
+
+    results = errors = 0
+    with urllib.request.urlopen(f"{base}/stream/{search_id}") as response:
+        for line in response:
+            line = line.decode('utf-8').strip()
+            if line.startswith('event: search_complete'):
+                break
+            if line.startswith('data: '):
+                item = json.loads(line[6:])
+                if item.get('type') == 'error':
+                    errors += 1
+                else:
+                    results += 1
+    return time.perf_counter() - start, results, errors, search_id
+
+
+def poll_results(base, search_id):
+    start = time.perf_counter()
+    with urllib.request.urlopen(f"{base}/results/{search_id}") as response:
+        response.read()
+    return time.perf_counter() - start
+
+
+def serve_flask(app_main, port):
+    from werkzeug.serving import make_server
+
+    logging.getLogger('werkzeug').setLevel(logging.WARNING)
+    server = make_server('127.0.0.1', port, app_main.app, threaded=True)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server.shutdown
+
+
+def serve_asgi(port):
+    import asgi
+    import uvicorn
+
+    server = uvicorn.Server(uvicorn.Config(asgi.app, host='127.0.0.1', port=port, log_level='warning',
+                                           backlog=4096, timeout_keep_alive=30))
+    thread = threading.Thread(target=server.run, daemon=True)
+    thread.start()
+    wait_for_port(port)
+
+    def shutdown():
+        server.should_exit = True
+        thread.join()
+    return shutdown
+
+
+def main():
+    parser = argparse.ArgumentParser(description="End-to-end search benchmark against a local stub server")
+    parser.add_argument('--clients', type=int, default=8, help="concurrent clients")
+    parser.add_argument('--searches', type=int, default=200, help="total searches")
+    parser.add_argument('--latency', type=float, default=0.05, help="stub latency per request, seconds")
+    parser.add_argument('--jitter', type=float, default=0.02, help="extra random stub latency, seconds")
+    parser.add_argument('--error-rate', type=float, default=0.0, help="fraction of stub responses that are 503s")
+    parser.add_argument('--stub-port', type=int, default=8765)
+    parser.add_argument('--app-port', type=int, default=8766)
+    parser.add_argument('--cache', action='store_true', help="keep the result cache on (queries are unique either way)")
+    parser.add_argument('--server', choices=('flask', 'asgi'), default='flask',
+                        help="serve the app with Flask's threaded server or natively on the finder's loop (needs uvicorn)")
+    parser.add_argument('--requests', type=int, default=2000, help="/results polls for the request throughput run")
+    parser.add_argument('--json', action='store_true', help="print the report as JSON")
+    args = parser.parse_args()
+
+    stub = multiprocessing.Process(target=serve, kwargs={
+        'port': args.stub_port,
+        'latency': args.latency,
+        'jitter': args.jitter,
+        'error_rate': args.error_rate,
+    }, daemon=True)
+    stub.start()
+    wait_for_port(args.stub_port)
+
+    # main.py configures itself from the environment at import time
+    os.environ['ZMQ_BIND'] = ''
+    # Only the stub server is reachable; warming would go to the real hosts
+    os.environ['WARM_INTERVAL'] = '0'
+    os.environ['SERVER_MODE'] = args.server
+    if not args.cache:
+        for name in ('CACHE_TTL', 'CRAIGSLIST_CACHE_TTL', 'EBAY_CACHE_TTL', 'OFFERUP_CACHE_TTL'):
+            os.environ[name] = '0'
+    import main as app_main
+
+    point_scrapers(app_main.finder.scrapers, f"http://127.0.0.1:{args.stub_port}")
+    shutdown = serve_asgi(args.app_port) if args.server == 'asgi' else serve_flask(app_main, args.app_port)
+    base = f"http://127.0.0.1:{args.app_port}"
+
+    # Warm up sessions, connection pools and the parse pool
+    _, _, _, warmup_id = run_search(base, 'warmup')
+
+    cpu_start = resource.getrusage(resource.RUSAGE_SELF)
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=args.clients) as clients:
+        outcomes = list(clients.map(lambda i: run_search(base, f"bike{i}"), range(args.searches)))
+    elapsed = time.perf_counter() - start
+    cpu_end = resource.getrusage(resource.RUSAGE_SELF)
+
+    # Plain request throughput: every client polls one finished search's results
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=args.clients) as clients:
+        polls = list(clients.map(lambda i: poll_results(base, warmup_id), range(args.requests)))
+    poll_elapsed = time.perf_counter() - start
+
+    connections = app_main.session_stats()
+    shutdown()
+    if args.server == 'flask':
+        app_main.finder.stop()
+    stub.terminate()
+
+    latencies = [latency for latency, _, _, _ in outcomes]
+    cpu = (cpu_end.ru_utime - cpu_start.ru_utime) + (cpu_end.ru_stime - cpu_start.ru_stime)
+    report = {
+        "server": args.server,
+        "searches": len(outcomes),
+        "clients": args.clients,
+        "searches_per_sec": len(outcomes) / elapsed,
+        "latency_p50": percentile(latencies, 0.50),
+        "latency_p95": percentile(latencies, 0.95),
+        "latency_p99": percentile(latencies, 0.99),
+        "latency_mean": statistics.mean(latencies),
+        # Process CPU, including the (light) client threads; parse pool
+        # workers are separate processes and not counted
+        "cpu_per_search": cpu / len(outcomes),
+        "results_per_search": sum(results for _, results, _, _ in outcomes) / len(outcomes),
+        "source_errors": sum(errors for _, _, errors, _ in outcomes),
+        "connection_reuse": sum(host['reused'] for host in connections.values()) /
+                            max(sum(host['requests'] for host in connections.values()), 1),
+        "requests_per_sec": len(polls) / poll_elapsed,
+        "request_latency_p50": percentile(polls, 0.50),
+        "request_latency_p99": percentile(polls, 0.99),
+    }
+
+    if args.json:
+        print(json.dumps(report, indent=2))
+    else:
+        print(f"{args.server}: {report['searches']} searches, {args.clients} clients, "
+              f"stub latency {args.latency * 1000:.0f}+{args.jitter * 1000:.0f}ms, error rate {args.error_rate:.0%}")
+        print(f"  throughput      {report['searches_per_sec']:.1f} searches/sec")
+        print(f"  latency         p50 {report['latency_p50'] * 1000:.0f}ms  "
+              f"p95 {report['latency_p95'] * 1000:.0f}ms  p99 {report['latency_p99'] * 1000:.0f}ms")
+        print(f"  cpu per search  {report['cpu_per_search'] * 1000:.1f}ms")
+        print(f"  results/search  {report['results_per_search']:.0f}  (source errors: {report['source_errors']})")
+        print(f"  connections     {report['connection_reuse']:.0%} of requests reused one")
+        print(f"  /results polls  {report['requests_per_sec']:.0f} requests/sec  "
+              f"p50 {report['request_latency_p50'] * 1000:.1f}ms  p99 {report['request_latency_p99'] * 1000:.1f}ms")
+
+
+if __name__ == "__main__":
+    main()
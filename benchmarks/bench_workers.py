@@ -0,0 +1,121 @@
+import argparse
+import json
+import multiprocessing
+import os
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(BENCH_DIR, '..', 'app'))
+sys.path.insert(0, BENCH_DIR)
+
+from bench_search import percentile, run_search, serve_flask, wait_for_port
+from stub_server import point_scrapers, serve
+
+
+def run_worker(stub_base):
+    os.environ['SERVER_MODE'] = 'worker'
+    import main
+
+    point_scrapers(main.finder.scrapers, stub_base)
+    main.finder.start()
+    threading.Event().wait()
+
+
+def run_broker(port):
+    import broker
+    broker.serve('127.0.0.1', port)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Search throughput against the number of worker processes")
+    parser.add_argument('--broker', choices=('sqlite', 'zmq'), default='sqlite')
+    parser.add_argument('--workers', default='1,2,4', help="comma separated worker counts to run")
+    parser.add_argument('--slots', type=int, default=2, help="concurrent searches per worker")
+    parser.add_argument('--clients', type=int, default=32, help="concurrent clients")
+    parser.add_argument('--searches', type=int, default=120, help="searches per run")
+    parser.add_argument('--latency', type=float, default=0.05, help="stub latency per request, seconds")
+    parser.add_argument('--stub-port', type=int, default=8765)
+    parser.add_argument('--app-port', type=int, default=8766)
+    parser.add_argument('--broker-port', type=int, default=5560)
+    parser.add_argument('--json', action='store_true', help="print the report as JSON")
+    args = parser.parse_args()
+
+    spawn = multiprocessing.get_context('spawn')
+    stub = spawn.Process(target=serve, kwargs={'port': args.stub_port, 'latency': args.latency}, daemon=True)
+    stub.start()
+    wait_for_port(args.stub_port)
+    stub_base = f"http://127.0.0.1:{args.stub_port}"
+
+    tmp = tempfile.TemporaryDirectory()
+    if args.broker == 'zmq':
+        broker_process = spawn.Process(target=run_broker, args=(args.broker_port,), daemon=True)
+        broker_process.start()
+        os.environ['BROKER_URL'] = f"zmq://127.0.0.1:{args.broker_port}"
+    else:
+        broker_process = None
+        os.environ['BROKER_URL'] = f"sqlite://{os.path.join(tmp.name, 'broker.db')}"
+
+    # Inherited by the spawned workers
+    os.environ['ZMQ_BIND'] = ''
+    # Only the stub server is reachable; warming would go to the real hosts
+    os.environ['WARM_INTERVAL'] = '0'
+    os.environ['MAX_CONCURRENT_SEARCHES'] = str(args.slots)
+    os.environ['MAX_QUEUE_SIZE'] = str(args.searches * 2)
+    for name in ('CACHE_TTL', 'CRAIGSLIST_CACHE_TTL', 'EBAY_CACHE_TTL', 'OFFERUP_CACHE_TTL'):
+        os.environ[name] = '0'
+    import main as app_main
+
+    shutdown = serve_flask(app_main, args.app_port)
+    base = f"http://127.0.0.1:{args.app_port}"
+    # Let the broker's subscriptions settle before the first search
+    time.sleep(0.5)
+
+    reports = []
+    for count in [int(count) for count in args.workers.split(',')]:
+        workers = [spawn.Process(target=run_worker, args=(stub_base,), daemon=True) for _ in range(count)]
+        for worker in workers:
+            worker.start()
+        for i in range(count * 2):
+            run_search(base, f'warmup{count}-{i}')
+
+        start = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=args.clients) as clients:
+            outcomes = list(clients.map(lambda i: run_search(base, f"bike{count}-{i}"), range(args.searches)))
+        elapsed = time.perf_counter() - start
+
+        for worker in workers:
+            worker.terminate()
+            worker.join()
+        latencies = [latency for latency, _, _, _ in outcomes]
+        reports.append({
+            "workers": count,
+            "searches_per_sec": len(outcomes) / elapsed,
+            "latency_p50": percentile(latencies, 0.50),
+            "latency_p99": percentile(latencies, 0.99),
+            "results_per_search": sum(results for _, results, _, _ in outcomes) / len(outcomes),
+        })
+
+    shutdown()
+    app_main.finder.stop()
+    if broker_process:
+        broker_process.terminate()
+    stub.terminate()
+    tmp.cleanup()
+
+    if args.json:
+        print(json.dumps(reports, indent=2))
+    else:
+        print(f"{args.broker} broker, {args.slots} searches per worker, {args.clients} clients, "
+              f"stub latency {args.latency * 1000:.0f}ms")
+        for report in reports:
+            print(f"  {report['workers']:>2} workers  {report['searches_per_sec']:6.1f} searches/sec  "
+                  f"p50 {report['latency_p50'] * 1000:.0f}ms  p99 {report['latency_p99'] * 1000:.0f}ms  "
+                  f"{report['results_per_search']:.0f} results/search")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,93 @@
+import argparse
+import os
+import random
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlsplit
+
+FIXTURES = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'fixtures')
+
+
+def load(name):
+    with open(os.path.join(FIXTURES, name), 'rb') as f:
+        return f.read()
+
+
+# Path prefix -> (content type, body); the scrapers' base URLs are pointed at
+# these prefixes by point_scrapers()
+ROUTES = {
+    '/craigslist/search/sss': ('text/html', b'<html><script>var searchPath = "sss";</script></html>'),
+    '/craigslist': ('text/html', b'<html><body>craigslist</body></html>'),
+    '/sapi/web/v8/postings/search/full': ('application/json', load('craigslist_bike.json')),
+    '/ebay/sch/i.html': ('text/html', load('ebay_bike.html')),
+    '/offerup/search': ('text/html', load('offerup_bike.html')),
+}
+
+
+def make_handler(latency=0.0, jitter=0.0, error_rate=0.0):
+    class StubHandler(BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'
+
+        def do_GET(self):
+            path = urlsplit(self.path).path
+            route = next((ROUTES[prefix] for prefix in ROUTES if path.startswith(prefix)), None)
+            delay = latency + random.uniform(0, jitter)
+            if delay > 0:
+                time.sleep(delay)
+
+            if route is None:
+                status, content_type, body = 404, 'text/plain', b'not found'
+            elif random.random() < error_rate:
+                status, content_type, body = 503, 'text/plain', b'injected error'
+            else:
+                status, (content_type, body) = 200, route
+
+            self.send_response(status)
+            self.send_header('Content-Type', content_type)
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass
+
+    return StubHandler
+
+
+def point_scrapers(scrapers, base):
+    """Point scrapers (and a region scraper's metros) at a stub server."""
+    for scraper in scrapers:
+        for target in getattr(scraper, 'metros', [scraper]):
+            name = target.__class__.__name__
+            if name == 'CraigslistScraper':
+                target.base_url = f"{base}/craigslist"
+                target.api_url = f"{base}/sapi/web/v8/postings/search/full"
+            elif name == 'EbayScraper':
+                target.base_url = f"{base}/ebay/sch/i.html"
+            elif name == 'OfferUpScraper':
+                target.base_url = f"{base}/offerup/search?q="
+
+
+def serve(host='127.0.0.1', port=8765, latency=0.0, jitter=0.0, error_rate=0.0):
+    server = ThreadingHTTPServer((host, port), make_handler(latency, jitter, error_rate))
+    server.daemon_threads = True
+    try:
+        server.serve_forever()
+    finally:
+        server.server_close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Serve recorded Craigslist, eBay and OfferUp responses")
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8765)
+    parser.add_argument('--latency', type=float, default=0.0, help="seconds added to every response")
+    parser.add_argument('--jitter', type=float, default=0.0, help="up to this many extra seconds, uniformly random")
+    parser.add_argument('--error-rate', type=float, default=0.0, help="fraction of requests answered with a 503")
+    args = parser.parse_args()
+    print(f"Stub server on http://{args.host}:{args.port}")
+    serve(args.host, args.port, args.latency, args.jitter, args.error_rate)
+
+
+if __name__ == "__main__":
+    main()
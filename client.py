@@ -9,7 +9,7 @@ if sys.platform.startswith('win'):
 class UsedItemsFinderClient:
     def __init__(self):
         self.zmq_context = zmq.asyncio.Context()
-        self.zmq_socket = self.zmq_context.socket(zmq.PAIR)
+        self.zmq_socket = self.zmq_context.socket(zmq.DEALER)
         self.zmq_socket.connect("tcp://localhost:5555")
 
     async def send_command(self, command):